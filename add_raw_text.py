@@ -1,27 +1,159 @@
-"""Adds the field body_paragraphs to all json files in the coll."""
+"""
+Adds the field body_paragraphs to all json files in the coll.
+
+Usage: add_raw_text.py in_dir out_dir [nb_workers] [gz|zst|-] [bs4|lxml]
+
+Incremental: a manifest in out_dir records the input signature (mtime and size, or content hash for packed
+collections) of every file written, so that an interrupted or repeated run only processes new or modified files,
+and the files whose output was deleted.
+
+The output files can be compressed with gzip or zstd; with zstd, a dictionary is trained on the input collection
+and saved in out_dir (see donnees.compression).
+
+The paragraphs are extracted with BeautifulSoup by default, or with the faster lxml engine, which gives the same
+paragraphs (see check_extractors.py).
+"""
 import os
 import sys
 
+from donnees import compression
+from donnees.coll_index import changed_entries, checked_signature, entry_name
 from donnees.rcan_coll import *
+from donnees.rcan_coll import count_document, run_chunks, run_stage
+
+MANIFEST = '.add_raw_text.manifest'
+CHUNK_SIZE = 256
+
+
+def load_manifest(out_dir):
+    """
+    :return: A dict file name -> input signature of the files already processed.
+    """
+    done = {}
+    manifest_file = os.path.join(out_dir, MANIFEST)
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r', encoding='utf-8') as fin:
+            for line in fin:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) == 2:  # ignores a line truncated by a crash
+                    done[parts[0]] = parts[1]
+    return done
+
+
+def write_atomically(output_file, doc, codec=None, dictionary=None):
+    tmp_file = os.path.join(os.path.dirname(output_file), '.' + os.path.basename(output_file) + '.tmp')
+    doc.write_to(tmp_file, codec, dictionary)
+    os.replace(tmp_file, output_file)
+
+
+def process_chunk(args, tasks):
+    """
+    Extracts the paragraphs of a chunk of documents and writes them.
+    :param args: (in_dir, out_dir, output codec, extraction engine).
+    :param tasks: A list of (entry, signature, signature in the manifest), see make_tasks.
+    :return: The list of (file name, signature) written, and the number of errors.
+    """
+    in_dir, out_dir, codec, engine = args
+    coll = RCollection(in_dir)
+    dictionary = None
+    if codec == 'zstd':
+        dictionary = compression.load_dictionary(os.path.join(out_dir, compression.ZSTD_DICT_FILE))
+    written = []
+    nb_errors = 0
+
+    for entry, signature, known_signature in tasks:
+        source_file = coll.source.source_file(entry)
+        name = os.path.basename(source_file)
+        output_file = os.path.join(out_dir, compression.compressed_name(name, codec))
+        data = b''
+        try:
+            data = run_stage('read', coll.source.read, entry)
+            signature = checked_signature(signature, known_signature, data)
+            if signature is None:
+                continue
+
+            doc = run_stage('decode', coll.decode, entry, data)
+            doc.extract_body_paragraphs(engine=engine)  # This will populate the BodyParagraphs field in the dict
+            write_atomically(output_file, doc, codec, dictionary)
+            written.append((name, signature))
+        except:
+            nb_errors += 1
+            print(f"Problem with {source_file}: {sys.exc_info()[0]}", file=sys.stderr)
+        count_document(len(data))
+
+    return written, nb_errors
+
+
+def make_tasks(coll, out_dir, done, codec=None):
+    """
+    :return: An iterator over the chunks of (entry, signature, known signature) to process. Files of a directory
+    collection are skipped here when unchanged and their output exists; documents of a packed collection are
+    checked by the workers, which need to read them to hash them. The known signature is None for the entries
+    without output.
+    """
+    entries = coll.source.entries()
+    signatures = [coll.source.signature(x) for x in entries]
+    known = {}
+    for entry, signature in zip(entries, signatures):
+        name = entry_name(entry)
+        output_file = os.path.join(out_dir, compression.compressed_name(name, codec))
+        if name in done:
+            if os.path.exists(output_file):
+                known[name] = done[name]
+        elif signature is not None and _output_is_newer(coll.source.source_file(entry), output_file):
+            known[name] = signature
+    _, chunks = changed_entries(entries, signatures, {k: (v, None) for k, v in known.items()}, CHUNK_SIZE)
+
+    for positions in chunks:
+        yield [(entries[i], signatures[i], known.get(entry_name(entries[i]))) for i in positions]
+
+
+def _output_is_newer(input_file, output_file):
+    try:
+        return os.stat(output_file).st_mtime_ns >= os.stat(input_file).st_mtime_ns
+    except FileNotFoundError:
+        return False
 
 
 def main():
+    if len(sys.argv) < 3:
+        print("Usage: prog in_dir out_dir [nb_workers] [gz|zst|-] [bs4|lxml]", file=sys.stderr)
+        sys.exit(1)
+
     in_dir = sys.argv[1]
     out_dir = sys.argv[2]
+    nb_workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    codec = compression.parse_codec(sys.argv[4]) if len(sys.argv) > 4 and sys.argv[4] != '-' else None
+    engine = sys.argv[5] if len(sys.argv) > 5 else 'bs4'
+    if engine not in ('bs4', 'lxml'):
+        print("The engine is bs4 or lxml", file=sys.stderr)
+        sys.exit(1)
 
+    os.makedirs(out_dir, exist_ok=True)
     coll = RCollection(in_dir)
+    done = load_manifest(out_dir)
+
+    dict_file = os.path.join(out_dir, compression.ZSTD_DICT_FILE)
+    if codec == 'zstd' and not os.path.exists(dict_file):
+        print("Training the compression dictionary...")
+        compression.save_dictionary(compression.train_dictionary(compression.sample_documents(coll.source)), dict_file)
     nb_docs = 0
+    nb_errors = 0
 
-    for doc in coll.find():
-        nb_docs += 1
-        if nb_docs % 1000 == 0:
-            print(nb_docs)
+    with open(os.path.join(out_dir, MANIFEST), 'a', encoding='utf-8') as manifest:
+        tasks = make_tasks(coll, out_dir, done, codec)
+        for written, chunk_errors in run_chunks(process_chunk, (in_dir, out_dir, codec, engine), tasks, nb_workers,
+                                                ordered=False):
+            manifest.write(''.join(f"{name}\t{signature}\n" for name, signature in written))
+            manifest.flush()
+            nb_errors += chunk_errors
 
-        try:
-            paras = doc.extract_body_paragraphs()  # This will populate the BodyParagraphs field in the dict
-            doc.write_to(os.path.join(out_dir, os.path.basename(doc['source_file'])))
-        except:
-            print(f"Problem with {doc['source_file']}: {sys.exc_info()[0]}", file=sys.stderr)
+            previous = nb_docs
+            nb_docs += len(written)
+            if nb_docs // 1000 != previous // 1000:
+                print(nb_docs)
+
+    print(f"{nb_docs} documents written, {nb_errors} errors.")
 
 
 if __name__ == '__main__':
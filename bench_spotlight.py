@@ -0,0 +1,62 @@
+"""
+Measures the throughput of the Spotlight annotator at several concurrency levels against a local stub server
+that answers after a fixed latency and fails a fraction of the requests with a 503.
+"""
+import http.server
+import random
+import sys
+import threading
+import time
+
+from donnees.spotlight import SpotlightAnnotator
+
+
+def make_stub_handler(latency, error_rate):
+    class StubHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(latency)
+            if random.random() < error_rate:
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            body = b'{"annotation": {"surfaceForm": []}}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def main():
+    nb_texts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.02
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), make_stub_handler(latency, error_rate))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/rest/candidates"
+    texts = [(i, f"Texte {i} " * 200) for i in range(nb_texts)]
+
+    print("concurrency\ttexts/s\trequests\tretries\terrors")
+    for concurrency in [1, 2, 4, 8, 16, 32]:
+        annotator = SpotlightAnnotator(url, concurrency=concurrency, backoff=0.01)
+        start = time.perf_counter()
+        nb_errors = sum(1 for _, result in annotator.annotate_all(texts) if isinstance(result, Exception))
+        duration = time.perf_counter() - start
+        print(f"{concurrency}\t{nb_texts / duration:.1f}\t{annotator.nb_requests}\t{annotator.nb_retries}\t{nb_errors}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Times the hot paths of the library on synthetic collections of several sizes: resource loading, iteration over
+directory and packed collections, paragraph extraction, stats passes and evaluation.
+
+Usage: benchmark.py [work_dir] [sizes=1000,10000] [results.json] [nb_workers]
+
+The collections are generated in work_dir once and reused. Results are saved as JSON; when the results file
+already exists, the new timings are compared to the previous ones and the file is replaced.
+"""
+import datetime
+import os
+import platform
+import shutil
+import sys
+import time
+
+import orjson
+import tabulate
+
+from donnees import rcan_coll
+from donnees.rcan_coll import RCollection, set_paragraph_cache
+from donnees.rcan_pack import pack_collection
+from donnees.synthetic import generate_collection, make_predictions
+from donnees.theme_stats import update_stats
+from eval_themes import encode_runs, evaluate_encoded, evaluate_themes
+from get_stats import merge_profiles, profile_docs
+
+RESULTS_VERSION = 1
+REGRESSION_RATIO = 1.1
+
+
+def timed(fn, nb_items=None, repeat=1):
+    """
+    :return: A result dict: the best time of repeat calls to fn and, given a number of items, the throughput.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    result = {'seconds': round(best, 6)}
+    if nb_items:
+        result['items_per_s'] = round(nb_items / best, 1)
+    return result
+
+
+def prepare(work_dir, nb_docs):
+    """
+    :return: (directory collection, packed collection, reference) of the synthetic corpus of nb_docs documents.
+    """
+    coll_dir = os.path.join(work_dir, f"coll-{nb_docs}")
+    pack_dir = os.path.join(work_dir, f"pack-{nb_docs}")
+    ref_file = os.path.join(work_dir, f"ref-{nb_docs}.json")
+    if not os.path.exists(ref_file):
+        shutil.rmtree(coll_dir, ignore_errors=True)
+        shutil.rmtree(pack_dir, ignore_errors=True)
+        print(f"Generating {nb_docs} documents...", file=sys.stderr, flush=True)
+        reference = generate_collection(coll_dir, nb_docs, seed=nb_docs)
+        pack_collection(coll_dir, pack_dir)
+        with open(ref_file, 'wb') as fout:
+            fout.write(orjson.dumps({str(k): v for k, v in reference.items()}))
+
+    with open(ref_file, 'rb') as fin:
+        reference = {int(k): v for k, v in orjson.loads(fin.read()).items()}
+    return coll_dir, pack_dir, reference
+
+
+def count(docs):
+    return sum(1 for _ in docs)
+
+
+def extract_all(coll, engine):
+    for doc in coll.find():
+        doc.extract_body_paragraphs(engine=engine)
+
+
+def run_benchmarks(work_dir, nb_docs, workers) -> dict:
+    coll_dir, pack_dir, reference = prepare(work_dir, nb_docs)
+    coll = RCollection(coll_dir)
+    packed = RCollection(pack_dir)
+    preds = make_predictions(reference, seed=nb_docs)
+
+    def evaluate_loop():
+        for run in ('theme', 'sub_themes'):
+            evaluate_themes(preds, reference, range(1, 6), run)
+
+    def evaluate_vectorized():
+        encoded = encode_runs(preds.items(), reference, ['theme', 'sub_themes'], 5)
+        for run in ('theme', 'sub_themes'):
+            evaluate_encoded(encoded[run], range(1, 6), run)
+
+    results = {
+        'resources.parse': timed(rcan_coll.parse_resources, repeat=5),
+        'find.directory': timed(lambda: count(coll.find()), nb_docs),
+        'find.directory.fields': timed(lambda: count(coll.find(fields=['ThemeId', 'SubThemeIds'])), nb_docs),
+        'find.packed': timed(lambda: count(packed.find()), nb_docs),
+        'find.packed.workers': timed(lambda: count(packed.find(workers=workers)), nb_docs),
+        'extract.bs4': timed(lambda: extract_all(packed, 'bs4'), nb_docs),
+        'extract.lxml': timed(lambda: extract_all(packed, 'lxml'), nb_docs),
+        'stats.themes': timed(lambda: update_stats(packed, None, workers), nb_docs),
+        'stats.profile': timed(lambda: packed.map_reduce(profile_docs, merge_profiles, workers=workers), nb_docs),
+        'eval.loop': timed(evaluate_loop, nb_docs),
+        'eval.vectorized': timed(evaluate_vectorized, nb_docs),
+    }
+    return results
+
+
+def compare(previous, current):
+    """
+    Prints the timings of current next to those of previous, flagging the benchmarks more than REGRESSION_RATIO
+    times slower.
+    """
+    rows = []
+    for size, results in current['results'].items():
+        for name, result in results.items():
+            before = previous.get('results', {}).get(size, {}).get(name)
+            if before is None:
+                rows.append([size, name, '', f"{result['seconds']:.3f}", '', ''])
+                continue
+            ratio = result['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+            rows.append([size, name, f"{before['seconds']:.3f}", f"{result['seconds']:.3f}", f"{ratio:.2f}",
+                         'slower' if ratio > REGRESSION_RATIO else ''])
+    print(tabulate.tabulate(rows, headers=['docs', 'benchmark', 'previous s', 'current s', 'ratio', ''],
+                            tablefmt='simple'))
+
+
+def main():
+    work_dir = sys.argv[1] if len(sys.argv) > 1 else 'bench_work'
+    sizes = [int(x) for x in sys.argv[2].split(',')] if len(sys.argv) > 2 else [1000, 10000]
+    results_file = sys.argv[3] if len(sys.argv) > 3 else 'bench_results.json'
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count()
+
+    # the extraction benchmarks time the extraction itself, not the cache
+    set_paragraph_cache(None)
+
+    current = {'version': RESULTS_VERSION, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'platform': platform.platform(), 'workers': workers,
+               'results': {}}
+    for nb_docs in sizes:
+        print(f"Benchmarking {nb_docs} documents...", file=sys.stderr, flush=True)
+        current['results'][str(nb_docs)] = run_benchmarks(work_dir, nb_docs, workers)
+
+    previous = None
+    if os.path.exists(results_file):
+        with open(results_file, 'rb') as fin:
+            previous = orjson.loads(fin.read())
+
+    if previous is not None and previous.get('version') == RESULTS_VERSION:
+        compare(previous, current)
+    else:
+        rows = [[size, name, f"{x['seconds']:.3f}", x.get('items_per_s', '')]
+                for size, results in current['results'].items() for name, x in results.items()]
+        print(tabulate.tabulate(rows, headers=['docs', 'benchmark', 'seconds', 'docs/s'], tablefmt='simple'))
+
+    with open(results_file, 'wb') as fout:
+        fout.write(orjson.dumps(current, option=orjson.OPT_INDENT_2))
+
+
+if __name__ == '__main__':
+    main()
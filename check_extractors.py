@@ -0,0 +1,61 @@
+"""
+Checks that the lxml paragraph extractor gives the same output as the BeautifulSoup one over a sample of the
+collection and a few bodies of malformed html, and compares their speed.
+"""
+import itertools
+import sys
+import time
+
+from donnees.rcan_coll import *
+
+# malformed bodies the two extractors must agree on, besides the sample
+EDGE_CASE_BODIES = [
+    '</html>word',
+    '<p>a</p></html><p>b</p>',
+    'a</html>b</body>c<!-- comment -->d',
+    '<span class="creator">x</html>y</span>z',
+    '<template><p>t</p></template>tail',
+    '<pre>  </pre> \n<!DOCTYPE html>\n<textarea>\n</textarea>',
+]
+
+
+def edge_case_documents():
+    for i, body in enumerate(EDGE_CASE_BODIES):
+        for url in ['https://www.ledevoir.com/', 'https://ici.radio-canada.ca/']:
+            yield RDocument({'_id': -1 - i, 'SearchableTitle': '', 'SearchableSummary': '',
+                             'FirstPublishedCanonicalWebLink': url, 'Lead': '<p>lead</p>', 'Body': body})
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: prog coll_dir [nb_docs]", file=sys.stderr)
+        sys.exit(1)
+
+    coll = RCollection(sys.argv[1])
+    nb_docs = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    docs = [x for x in itertools.islice(coll.find(), nb_docs) if x is not None]
+    docs.extend(edge_case_documents())
+    timings = {}
+    outputs = {}
+    for engine in ['bs4', 'lxml']:
+        start = time.perf_counter()
+        outputs[engine] = [doc._extract_body_paragraphs(engine) for doc in docs]
+        timings[engine] = time.perf_counter() - start
+
+    nb_diffs = 0
+    for doc, expected, actual in zip(docs, outputs['bs4'], outputs['lxml']):
+        if expected != actual:
+            nb_diffs += 1
+            print(f"Different paragraphs for {doc.get('source_file', repr(doc['Body']))}", file=sys.stderr)
+
+    print(f"{len(docs)} docs, {nb_diffs} differences")
+    for engine, duration in timings.items():
+        print(f"{engine}: {duration:.2f}s ({len(docs) / duration:.0f} docs/s)")
+    print(f"speedup: {timings['bs4'] / timings['lxml']:.1f}x")
+
+    sys.exit(1 if nb_diffs else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Compares theme prediction files: bootstrap confidence intervals of P/R/F1@n for every system, and paired
+approximate randomization tests of every system against the first one.
+"""
+import os
+import sys
+
+import tabulate
+
+from donnees.predictions import iter_predictions
+from donnees.ref_store import load_theme_reference
+from eval_themes import align_counts, bootstrap_ci, doc_counts, encode_runs, paired_randomization_test, \
+    prf_from_sums
+
+
+def main():
+    if len(sys.argv) < 5:
+        print("Usage: prog theme|sub_themes n nb_resamples predictions.json+", file=sys.stderr)
+        sys.exit(1)
+
+    run = sys.argv[1]
+    n = int(sys.argv[2])
+    nb_resamples = int(sys.argv[3])
+    pred_files = sys.argv[4:]
+    workers = os.cpu_count()
+
+    theme_refs = load_theme_reference()
+    encoded = [encode_runs(iter_predictions(x), theme_refs, [run], n)[run] for x in pred_files]
+    counts = [doc_counts(x, n) for x in encoded]
+
+    rows = []
+    for pred_file, cur_counts in zip(pred_files, counts):
+        metrics = prf_from_sums(cur_counts.sum(axis=1))
+        ci = bootstrap_ci(cur_counts, nb_resamples, workers=workers)
+        rows.append([pred_file] + [f"{metrics[i]:.3f} [{ci[i][0]:.3f}, {ci[i][1]:.3f}]" for i in range(3)])
+
+    print(f"{run} @{n}, 95% bootstrap confidence intervals over {nb_resamples} resamples")
+    print(tabulate.tabulate(rows, headers=["system", "p", "r", "f1"], tablefmt="simple"))
+    print()
+
+    rows = []
+    for i in range(1, len(pred_files)):
+        counts_a, counts_b = align_counts(encoded[0], counts[0], encoded[i], counts[i])
+        delta = prf_from_sums(counts_b.sum(axis=1)) - prf_from_sums(counts_a.sum(axis=1))
+        p_values = paired_randomization_test(counts_a, counts_b, nb_resamples, workers=workers)
+        rows.append([pred_files[i], counts_a.shape[1]] + [f"{delta[j]:+.3f} (p={p_values[j]:.4f})" for j in range(3)])
+
+    if rows:
+        print(f"Paired approximate randomization against {pred_files[0]}")
+        print(tabulate.tabulate(rows, headers=["system", "docs", "p", "r", "f1"], tablefmt="simple"))
+
+
+if __name__ == '__main__':
+    main()
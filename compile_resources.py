@@ -0,0 +1,14 @@
+"""
+Compiles the theme resource files into a single binary snapshot, loaded faster by donnees.rcan_coll. The snapshot
+is ignored once the resource files are modified: run this again after updating them.
+"""
+from donnees.rcan_coll import *
+
+
+def main():
+    compile_resources()
+    print(f"Wrote {RESOURCE_SNAPSHOT}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+"""Converts a pickled theme reference (e.g. ref-rcan-themes.pkl.bz2) to the columnar store of donnees.ref_store."""
+import bz2
+import pickle
+import sys
+
+from donnees.ref_store import DEFAULT_PREFIX, write_reference
+
+
+def main():
+    in_file = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PREFIX + '.pkl.bz2'
+    prefix = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_PREFIX
+
+    opener = bz2.open if in_file.endswith('.bz2') else open
+    with opener(in_file, 'rb') as fin:
+        reference = pickle.load(fin)
+
+    write_reference(reference, prefix)
+    print(f"{len(reference)} references written to {prefix}.*.npy")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,37 @@
-import math
+"""
+Splits the documents with valid themes into train/valid/test sets, in a single streaming pass.
+
+Usage: create_rcan_split.py coll_dir out_dir valid_themes|valid_themes_and_subthemes [mode] [valid_from test_from]
+    [dedup]
+
+Modes:
+- random (default): 80/10/10, every document assigned by a hash of its id, so that the assignment of a document
+  never changes when the collection grows;
+- stratified: 80/10/10 within every theme, every document assigned by a hash of its id salted with its theme, so
+  that every theme is split independently and the assignment never changes when the collection grows either;
+- date: documents published before valid_from go to train, before test_from to valid, the others to test (dates
+  compared as ISO 8601 strings, e.g. 2019-01-01).
+
+With dedup, near-duplicate articles (see near_dups.py) are kept in one split: every document of a cluster is
+assigned like the cluster representative (its smallest id) in random and stratified modes, by the earliest publish
+date of the cluster in date mode, whatever the order the documents are read in.
+"""
+import array
+import hashlib
 import os
-import pickle
-import random
 import sys
 
+import numpy
+
+from donnees.near_dup import near_dup_index
 from donnees.rcan_coll import *
+from donnees.ref_store import ReferenceBuilder
 
-random.seed(42)
+SPLITS = ('train', 'valid', 'test')
+SPLIT_RATIOS = (0.8, 0.1, 0.1)
+PUBLISH_FIELD = 'FirstPublishedDate'
+HASH_SALT = '42'
+_WRITE_BUFFER_SIZE = 1 << 20
 
 
 def valid_theme(theme):
@@ -26,16 +51,84 @@ def valid_subthemes(subthemes):
     return result
 
 
-def write_subset(sublist, fout_name):
-    with open(fout_name, 'w') as fout:
-        for id in sorted(sublist):
-            print(id, file=fout)
+def hash_fraction(doc_id, salt=None) -> float:
+    """
+    :param salt: If given, drawn from the doc id and salt.
+    :return: A number in [0, 1) drawn from the doc id, the same for every run.
+    """
+    key = f"{HASH_SALT}:{doc_id}" if salt is None else f"{HASH_SALT}:{salt}:{doc_id}"
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+def hash_split(doc_id, salt=None) -> int:
+    u = hash_fraction(doc_id, salt)
+    cumulative = 0.0
+    for split, ratio in enumerate(SPLIT_RATIOS):
+        cumulative += ratio
+        if u < cumulative:
+            return split
+    return len(SPLITS) - 1
+
+
+def stratified_split(doc_id, theme_id: int) -> int:
+    return hash_split(doc_id, f"theme={int(theme_id)}")
+
+
+def date_split(date: str, valid_from: str, test_from: str) -> int:
+    if date < valid_from:
+        return 0
+    return 1 if date < test_from else 2
+
+
+def cluster_splits(coll, representatives: dict, mode: str, valid_from: str, test_from: str) -> dict:
+    """
+    :param representatives: A dict doc id -> doc id of the representative of its cluster, see
+    NearDupIndex.representatives.
+    :return: A dict representative -> split of its cluster, computed from the representative (random and
+    stratified modes) or from the earliest publish date of the cluster (date mode), looked up in the index of the
+    collection. Clusters without any date are left out.
+    """
+    if mode == 'random':
+        return {x: hash_split(x) for x in set(representatives.values())}
+
+    index = coll.index(os.cpu_count())
+    positions = {x: i for i, x in enumerate(index.doc_ids.tolist())}
+    if mode == 'stratified':
+        return {x: stratified_split(x, index.themes[positions[x]]) for x in set(representatives.values())}
+
+    earliest = {}
+    for member, representative in representatives.items():
+        date = index.dates[positions[member]]
+        if not numpy.isnat(date) and (representative not in earliest or date < earliest[representative]):
+            earliest[representative] = date
+    return {x: date_split(str(y), valid_from, test_from) for x, y in earliest.items()}
+
+
+def write_ids(ids, fout_name):
+    """Writes ids, an array('q'), sorted, one per line."""
+    ids = numpy.sort(numpy.frombuffer(ids, dtype=numpy.int64))
+    with open(fout_name, 'w', buffering=_WRITE_BUFFER_SIZE) as fout:
+        for i in range(0, len(ids), 65536):
+            fout.write(''.join(f"{x}\n" for x in ids[i:i + 65536].tolist()))
 
 
 def main():
+    if len(sys.argv) < 4:
+        print("Usage: prog coll_dir out_dir valid_themes|valid_themes_and_subthemes [random|stratified|date] "
+              "[valid_from test_from] [dedup]", file=sys.stderr)
+        sys.exit(1)
+
     coll_dir = sys.argv[1]
     out_dir = sys.argv[2]
     validate_subthemes = sys.argv[3] == 'valid_themes_and_subthemes'
+    options = [x for x in sys.argv[4:] if x != 'dedup']
+    dedup = len(options) < len(sys.argv) - 4
+    mode = options[0] if options else 'random'
+    if mode not in ('random', 'stratified', 'date') or (mode == 'date' and len(options) < 3):
+        print("The mode is random, stratified or date valid_from test_from", file=sys.stderr)
+        sys.exit(1)
+    valid_from, test_from = options[1:3] if mode == 'date' else (None, None)
 
     if validate_subthemes:
         print("Themes and subthemes must be valid")
@@ -43,39 +136,55 @@ def main():
         print("Only themes must be valid")
 
     coll = RCollection(coll_dir)
-    reference = {}
+    reference = ReferenceBuilder()
+    split_ids = [array.array('q') for _ in SPLITS]
+    representatives = near_dup_index(coll, os.cpu_count()).representatives() if dedup else {}
+    splits_of_clusters = cluster_splits(coll, representatives, mode, valid_from, test_from) if dedup else {}
+    nb_clustered = 0
 
-    good_article_ids = set()
     nb_bad_articles = 0
+    nb_undated = 0
     nb_docs = 0
-    for doc in coll.find():
+    for doc in coll.find(fields=['ThemeId', 'SubThemeIds', PUBLISH_FIELD]):
         nb_docs += 1
         if nb_docs % 1000 == 0:
             print(f"{nb_docs}...")
 
-        if valid_theme(doc.theme) and (not validate_subthemes or valid_subthemes(doc.subthemes)):
-            good_article_ids.add(doc.id)
-            reference[doc.id] = [doc.theme['id']] + [x['id'] for x in doc.subthemes]
-        else:
+        if not valid_theme(doc.theme) or (validate_subthemes and not valid_subthemes(doc.subthemes)):
             nb_bad_articles += 1
-
-    print(f"{len(good_article_ids)} good articles, {nb_bad_articles} bad ones.")
-
-    with open(os.path.join(out_dir, 'all_good.ids'), 'w') as fout:
-        for id in sorted(good_article_ids):
-            print(str(id), file=fout)
-
-    good_ids = list(sorted(good_article_ids))
-    random.shuffle(good_ids)
-
-    nb_good_ids = len(good_ids)
-    valid_split = math.floor(0.8 * nb_good_ids)
-    test_split = math.floor(0.9 * nb_good_ids)
-
-    write_subset(good_ids[0:valid_split], os.path.join(out_dir, 'train.ids'))
-    write_subset(good_ids[valid_split:test_split], os.path.join(out_dir, 'valid.ids'))
-    write_subset(good_ids[test_split:], os.path.join(out_dir, 'test.ids'))
-    pickle.dump(reference, open(os.path.join(out_dir, 'ref-themes.pkl'), 'wb'))
+            continue
+
+        if mode == 'date':
+            date = doc.get(PUBLISH_FIELD)
+            if not date:
+                nb_undated += 1
+                continue
+
+        representative = representatives.get(int(doc.id))
+        if representative in splits_of_clusters:
+            split = splits_of_clusters[representative]
+            nb_clustered += 1
+        elif mode == 'date':
+            split = date_split(date, valid_from, test_from)
+        elif mode == 'stratified':
+            split = stratified_split(doc.id, doc.theme['id'])
+        else:
+            split = hash_split(doc.id)
+
+        split_ids[split].append(int(doc.id))
+        reference.add(doc.id, [doc.theme['id']] + [x['id'] for x in doc.subthemes])
+
+    print(f"{len(reference)} good articles, {nb_bad_articles} bad ones.")
+    if nb_undated:
+        print(f"{nb_undated} good articles without {PUBLISH_FIELD} left out.")
+    if dedup:
+        print(f"{nb_clustered} near-duplicates put in the split of their cluster.")
+
+    write_ids(reference.ids, os.path.join(out_dir, 'all_good.ids'))
+    for name, ids in zip(SPLITS, split_ids):
+        print(f"{name}: {len(ids)}")
+        write_ids(ids, os.path.join(out_dir, f"{name}.ids"))
+    reference.write(os.path.join(out_dir, 'ref-themes'))
 
 
 if __name__ == '__main__':
@@ -1,43 +1,79 @@
 """Extracts entities from DBPedia Spotlight."""
 
 import os
-import requests
-from requests import HTTPError
+import sys
 
+from donnees import compression
+from donnees.cache import SQLiteLRUCache
 from donnees.rcan_coll import *
+from donnees.spotlight import DEFAULT_URL, DoneSet, SpotlightAnnotator
+
+DONE_FILE = '.spotlight.done'
+
+
+def texts_to_annotate(coll, out_dir, done, codec=None):
+    """
+    :param codec: Compression of the output files, see donnees.compression.
+    :return: An iterator over (output file, text) for the documents not annotated yet. Documents without text
+    are marked as such right away.
+    """
+    nb_docs = 0
+    for doc in coll.find():
+        nb_docs += 1
+        if nb_docs % 1000 == 0:
+            print(nb_docs)
+
+        name = compression.compressed_name(os.path.basename(doc['source_file']), codec)
+        output_file = os.path.join(out_dir, name)
+        if name in done or os.path.exists(output_file):
+            continue
+
+        paras = doc.extract_body_paragraphs()
+        text = '\n'.join(paras).replace('<', ' ')
+
+        if paras and 'amp;amp;amp;amp;amp;amp;amp;amp;amp;amp;amp;' not in text:
+            yield output_file, text
+        else:
+            with open(output_file, 'wb') as fout:
+                fout.write(compression.compress(b'{ "notext": true }', codec))
+            done.add(name)
 
 
 def main():
+    if len(sys.argv) < 3:
+        print("Usage: prog in_dir out_dir [concurrency] [url] [cache_file|-] [paragraphs|-] [gz|zst]", file=sys.stderr)
+        sys.exit(1)
+
     in_dir = sys.argv[1]
     out_dir = sys.argv[2]
-    url = "http://octal15.iro.umontreal.ca:8081/rest/candidates"
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    url = sys.argv[4] if len(sys.argv) > 4 else DEFAULT_URL
+    cache = SQLiteLRUCache(sys.argv[5]) if len(sys.argv) > 5 and sys.argv[5] != '-' else None
+    paragraph_level = len(sys.argv) > 6 and sys.argv[6] == 'paragraphs'
+    codec = compression.parse_codec(sys.argv[7]) if len(sys.argv) > 7 else None
 
     coll = RCollection(in_dir)
-    nb_docs = 0
+    annotator = SpotlightAnnotator(url, concurrency=concurrency, cache=cache, paragraph_level=paragraph_level)
+    done = DoneSet(os.path.join(out_dir, DONE_FILE))
+
+    for output_file, result in annotator.annotate_all(texts_to_annotate(coll, out_dir, done, codec)):
+        if isinstance(result, Exception):
+            print(f"Problem with {output_file}: {result}", file=sys.stderr)
+            continue
+
+        tmp_file = output_file + '.tmp'
+        with open(tmp_file, 'wb') as fout:
+            fout.write(compression.compress(result, codec))
+        os.replace(tmp_file, output_file)
+        done.add(os.path.basename(output_file))
 
-    with requests.Session() as session:
-        for doc in coll.find():
-            nb_docs += 1
-            if nb_docs % 1000 == 0:
-                print(nb_docs)
-
-            paras = doc.extract_body_paragraphs()
-            text = '\n'.join(paras).replace('<', ' ')
-            output_file = os.path.join(out_dir, os.path.basename(doc['source_file']))
-
-            if not os.path.exists(output_file):
-                try:
-                    if paras and 'amp;amp;amp;amp;amp;amp;amp;amp;amp;amp;amp;' not in text:
-                        response = session.post(url, {'text': text, 'confidence': 0.4, 'support': -1},
-                                                headers={'Accept': 'application/json'},)
-                        response.raise_for_status()
-                        with open(output_file, 'wb') as fout:
-                            fout.write(response.content)
-                    else:
-                        open(output_file, 'w', encoding='utf-8').write('{ "notext": true }')
-
-                except HTTPError as e:
-                    print(f"Problem with {doc['source_file']}: {e}", file=sys.stderr)
+    done.close()
+    stats = annotator.stats()
+    print(f"{stats['requests']} requests, {stats['retries']} retries.")
+    if cache is not None:
+        print(f"Cache: {stats['hits']} hits, {stats['misses']} misses ({100 * stats['hit_rate']:.1f}% hit rate), "
+              f"{stats['shared_in_flight']} shared in flight.")
+        cache.close()
 
 
 if __name__ == '__main__':
@@ -7,9 +7,9 @@ from donnees.rcan_coll import *
 
 def main():
     coll = RCollection('/data/rali6/Tmp/gottif/radiocan/data/radio-can-articles/')
-    # A directory on your local machine will improve performance tenfold!
+    # A directory on your local machine will improve performance tenfold! Otherwise, read ahead with a few threads.
 
-    for doc in coll.find():
+    for doc in coll.find(prefetch=16):
         # access the JSON file keys directly...
         is_dispatch = doc['IsDispatch']
 
@@ -0,0 +1,113 @@
+"""
+Persistent key/value caches backed by SQLite.
+
+(c) RALI, Université de Montréal.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import orjson
+
+
+class SQLiteLRUCache:
+    """
+    A local store of JSON-serializable values, with an optional size cap enforced by evicting the least recently
+    used entries. Hit and miss counters are kept for the lifetime of the object. The cache can be shared by
+    threads, and by the workers of RCollection.map_reduce: the connection is reopened after a fork.
+    """
+    def __init__(self, path: str, max_bytes: int = None):
+        """
+        :param path: SQLite database file, created if needed.
+        :param max_bytes: Maximum total size of the stored values, unlimited if None.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+        self._nb_puts = 0
+        self._lock = threading.RLock()
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                               'size INTEGER NOT NULL, last_access REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS cache_last_access ON cache(last_access)')
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str):
+        """
+        :return: The value stored under key, None if absent.
+        """
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if self.max_bytes is not None:
+                conn.execute('UPDATE cache SET last_access = ? WHERE key = ?', (time.time(), key))
+        return orjson.loads(row[0])
+
+    def put(self, key: str, value):
+        data = orjson.dumps(value)
+        with self._lock:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)', (key, data, len(data), time.time()))
+
+            self._nb_puts += 1
+            if self.max_bytes is not None and self._nb_puts % 100 == 0:
+                self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes."""
+        if self.max_bytes is None:
+            return
+
+        with self._lock:
+            conn = self._connection()
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+
+            to_free = total - self.max_bytes
+            freed = 0
+            keys = []
+            for key, size in conn.execute('SELECT key, size FROM cache ORDER BY last_access'):
+                keys.append((key,))
+                freed += size
+                if freed >= to_free:
+                    break
+            conn.executemany('DELETE FROM cache WHERE key = ?', keys)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self.evict()
+                self._conn.close()
+                self._conn = None
+
+
+def content_key(*parts) -> str:
+    """
+    :return: A hex digest identifying the concatenation of parts (strings).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
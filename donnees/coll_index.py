@@ -0,0 +1,275 @@
+"""
+Secondary indexes of a collection, used by RCollection.find(where=...) to read only the matching documents.
+
+The index holds, for every entry of the collection, the values of a few fields as NumPy arrays: ThemeId,
+SubThemeIds, the source (Le Devoir or Radio-Canada), IsDispatch and the publish date. It is built in one pass and
+saved next to the collection, or to a given path, along with the signature of every entry; when entries are added,
+removed or rewritten, only the new and modified ones are indexed again.
+
+(c) RALI, Université de Montréal.
+"""
+import os
+import sys
+
+import numpy
+
+from donnees.rcan_pack import content_signature
+
+INDEX_VERSION = 2
+PUBLISH_FIELD = 'FirstPublishedDate'
+SOURCES = ('radio-canada', 'ledevoir')
+INDEX_FIELDS = ['ThemeId', 'SubThemeIds', 'IsDispatch', PUBLISH_FIELD]
+_NAT = numpy.datetime64('NaT', 'D')
+
+
+def default_index_path(col_spec: str, packed: bool) -> str:
+    """
+    :return: The index file of a collection: inside a packed collection, next to a directory collection (every
+    file of which is a document).
+    """
+    if packed:
+        return os.path.join(col_spec, 'rcan-index.npz')
+    return os.path.normpath(col_spec) + '.rcan-index.npz'
+
+
+def entry_name(entry) -> str:
+    return entry if isinstance(entry, str) else entry.name
+
+
+def entry_signatures(source, entries) -> list:
+    """
+    :return: The signature of every entry of source, which changes when its document is rewritten: the file
+    signature in a directory collection, the location of the record in a packed one (see
+    PackedSource.location_signature).
+    """
+    result = []
+    for entry in entries:
+        signature = source.signature(entry)
+        result.append(source.location_signature(entry) if signature is None else signature)
+    return result
+
+
+def changed_entries(entries: list, signatures: list, previous: dict, chunk_size: int) -> tuple:
+    """
+    Compares the entries of a collection with those processed by an earlier run, for the incremental updates.
+    :param signatures: The signatures of entries, e.g. entry_signatures(). None stands for a signature known once
+    the entry is read, see checked_signature().
+    :param previous: A dict entry name -> (signature, result) of the entries processed by the earlier run.
+    :return: (reused, chunks): a dict position -> earlier result of the entries with the same signature, and the
+    positions of the other entries, to process, in lists of at most chunk_size.
+    """
+    reused = {}
+    missing = []
+    for i, (entry, signature) in enumerate(zip(entries, signatures)):
+        known = previous.get(entry_name(entry))
+        if signature is not None and known is not None and known[0] == signature:
+            reused[i] = known[1]
+        else:
+            missing.append(i)
+    return reused, [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+
+
+def checked_signature(signature, known_signature, data: bytes):
+    """
+    :param signature: The signature of an entry given by changed_entries(), None to hash its content.
+    :param known_signature: Its signature in the earlier run, None if it was not processed.
+    :param data: Its raw content.
+    :return: The signature of the entry, or None when it was hashed and is known_signature: the entry is
+    unchanged.
+    """
+    if signature is not None:
+        return signature
+    signature = content_signature(data)
+    return None if signature == known_signature else signature
+
+
+def _parse_date(value):
+    if not isinstance(value, str) or len(value) < 10:
+        return _NAT
+    try:
+        return numpy.datetime64(value[:10], 'D')
+    except ValueError:
+        return _NAT
+
+
+def index_rows(docs_and_entries) -> list:
+    """
+    :param docs_and_entries: An iterable of (RDocument or None when unreadable, entry).
+    :return: The index rows: (name, doc id, theme id, subtheme ids, source, dispatch, date), -1 standing for
+    missing values.
+    """
+    rows = []
+    for doc, entry in docs_and_entries:
+        if doc is None:
+            rows.append((entry_name(entry), -1, -1, (), -1, -1, _NAT))
+            continue
+
+        theme = doc.get('ThemeId')
+        dispatch = doc.get('IsDispatch')
+        rows.append((entry_name(entry), int(doc.id), -1 if theme is None else int(theme),
+                     tuple(int(x) for x in doc.get('SubThemeIds') or ()), int('ledevoir' in doc.url),
+                     -1 if dispatch is None else int(bool(dispatch)), _parse_date(doc.get(PUBLISH_FIELD))))
+    return rows
+
+
+class CollectionIndex:
+    """
+    Field values of every entry of a collection, in arrays aligned with names, the entry names, and signatures,
+    their signatures when they were indexed.
+    """
+    def __init__(self, names, signatures, doc_ids, themes, sub_offsets, subthemes, sources, dispatches, dates):
+        self.names = names
+        self.signatures = signatures
+        self.doc_ids = doc_ids
+        self.themes = themes
+        self.sub_offsets = sub_offsets
+        self.subthemes = subthemes
+        self.sources = sources
+        self.dispatches = dispatches
+        self.dates = dates
+
+    @staticmethod
+    def from_rows(rows: list, signatures: list) -> 'CollectionIndex':
+        """
+        :param rows: The rows of the entries, see index_rows.
+        :param signatures: The signatures of the entries, see entry_signatures.
+        """
+        lengths = numpy.fromiter((len(x[3]) for x in rows), dtype=numpy.int64, count=len(rows))
+        sub_offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=sub_offsets[1:])
+        return CollectionIndex(numpy.array([x[0] for x in rows], dtype=str), numpy.array(signatures, dtype=str),
+                               numpy.array([x[1] for x in rows], dtype=numpy.int64),
+                               numpy.array([x[2] for x in rows], dtype=numpy.int32),
+                               sub_offsets,
+                               numpy.fromiter((y for x in rows for y in x[3]), dtype=numpy.int32,
+                                              count=int(sub_offsets[-1])),
+                               numpy.array([x[4] for x in rows], dtype=numpy.int8),
+                               numpy.array([x[5] for x in rows], dtype=numpy.int8),
+                               numpy.array([x[6] for x in rows], dtype='datetime64[D]'))
+
+    def __len__(self):
+        return len(self.names)
+
+    def row(self, i: int) -> tuple:
+        """
+        :return: The row of entry i, see index_rows.
+        """
+        return (str(self.names[i]), int(self.doc_ids[i]), int(self.themes[i]),
+                tuple(self.subthemes[self.sub_offsets[i]:self.sub_offsets[i + 1]].tolist()), int(self.sources[i]),
+                int(self.dispatches[i]), self.dates[i])
+
+    def is_current(self, names: list, signatures: list) -> bool:
+        """
+        :return: True if the index holds exactly the entries names, unchanged since they were indexed.
+        """
+        return self.names.tolist() == names and self.signatures.tolist() == signatures
+
+    def save(self, path: str):
+        with open(path + '.tmp', 'wb') as fout:
+            numpy.savez(fout, version=INDEX_VERSION, names=self.names, signatures=self.signatures,
+                        doc_ids=self.doc_ids, themes=self.themes, sub_offsets=self.sub_offsets,
+                        subthemes=self.subthemes, sources=self.sources, dispatches=self.dispatches,
+                        dates=self.dates)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def load(path: str):
+        """
+        :return: The saved index, or None when it does not exist or was saved by another version.
+        """
+        if not os.path.exists(path):
+            return None
+        with numpy.load(path) as data:
+            if int(data['version']) != INDEX_VERSION:
+                return None
+            return CollectionIndex(*[data[x] for x in ('names', 'signatures', 'doc_ids', 'themes', 'sub_offsets',
+                                                       'subthemes', 'sources', 'dispatches', 'dates')])
+
+    def match(self, where: dict) -> numpy.ndarray:
+        """
+        :param where: A dict of conditions, all of which must hold:
+        - 'ThemeId': a theme id or a collection of theme ids;
+        - 'active_theme': True (False) for the documents with an active (inactive or missing) theme;
+        - 'SubThemeIds': a subtheme id or a collection of them, at least one of which the document has;
+        - 'source': 'ledevoir' or 'radio-canada';
+        - 'IsDispatch': a bool;
+        - 'date': (start, end), ISO dates (e.g. '2018-01-01'), start included, end excluded, either may be None.
+        :return: A boolean mask over the entries.
+        """
+        mask = self.doc_ids >= 0
+        for key, value in where.items():
+            if key == 'ThemeId':
+                mask &= numpy.isin(self.themes, _id_array(value))
+            elif key == 'active_theme':
+                from donnees.rcan_coll import resources
+                active = [x.id for x in resources().themes.values() if x.active]
+                mask &= numpy.isin(self.themes, active) == bool(value)
+            elif key == 'SubThemeIds':
+                hits = numpy.isin(self.subthemes, _id_array(value)).astype(numpy.int64)
+                counts = numpy.concatenate(([0], numpy.cumsum(hits)))
+                mask &= counts[self.sub_offsets[1:]] > counts[self.sub_offsets[:-1]]
+            elif key == 'source':
+                if value not in SOURCES:
+                    raise ValueError(f"Unknown source {value}, expected one of {SOURCES}")
+                mask &= self.sources == SOURCES.index(value)
+            elif key == 'IsDispatch':
+                mask &= self.dispatches == int(bool(value))
+            elif key == 'date':
+                start, end = value
+                if start is not None:
+                    mask &= self.dates >= numpy.datetime64(start, 'D')
+                if end is not None:
+                    mask &= self.dates < numpy.datetime64(end, 'D')
+            else:
+                raise ValueError(f"Unknown condition {key}")
+        return mask
+
+    def match_names(self, where: dict) -> list:
+        """
+        :return: The names of the entries matching where, see match().
+        """
+        return self.names[self.match(where)].tolist()
+
+
+def _id_array(value):
+    if isinstance(value, (int, numpy.integer, str)):
+        return numpy.array([int(value)])
+    return numpy.array([int(x) for x in value])
+
+
+def build_index(coll, workers: int = None, chunk_size: int = 1024, previous: CollectionIndex = None,
+                entries: list = None, signatures: list = None) -> CollectionIndex:
+    """
+    Reads the indexed fields of the documents of coll.
+    :param previous: An index of an earlier state of the collection: the rows of the entries it holds with the same
+    signature are reused, only the other documents are read.
+    :param entries: The entries of coll, read from its source if None.
+    :param signatures: Their signatures (see entry_signatures), computed if None.
+    """
+    from donnees.rcan_coll import run_chunks
+
+    entries = coll.source.entries() if entries is None else entries
+    signatures = entry_signatures(coll.source, entries) if signatures is None else signatures
+    known = {}
+    if previous is not None:
+        known = {x: (y, i) for i, (x, y) in enumerate(zip(previous.names.tolist(), previous.signatures.tolist()))}
+    reused, chunks = changed_entries(entries, signatures, known, chunk_size)
+    rows = [None] * len(entries)
+    for i, j in reused.items():
+        rows[i] = previous.row(j)
+
+    tasks = ([entries[x] for x in y] for y in chunks)
+    for positions, chunk_rows in zip(chunks, run_chunks(_index_chunk, coll.col_spec, tasks, workers)):
+        for i, row in zip(positions, chunk_rows):
+            rows[i] = row
+    nb_failed = sum(1 for x in rows if x[1] < 0)
+    if nb_failed:
+        print(f"{nb_failed} documents could not be indexed", file=sys.stderr)
+    return CollectionIndex.from_rows(rows, signatures)
+
+
+def _index_chunk(col_spec, entries):
+    from donnees.rcan_coll import RCollection, RCollectionIt
+
+    source = RCollection(col_spec).source
+    return index_rows(zip(RCollectionIt(source, entries, INDEX_FIELDS), entries))
@@ -0,0 +1,142 @@
+"""
+Compressed documents at rest.
+
+Documents of a directory collection may be stored as <name>.json, <name>.json.gz or <name>.json.zst. zstd files
+may be compressed with a dictionary trained on the collection, which compresses small documents much better; it is
+stored in the collection directory as rcan.zstd-dict, and packs record theirs in their manifest.
+
+(c) RALI, Université de Montréal.
+"""
+import gzip
+import os
+import random
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DOC_SUFFIXES = ('.json', '.json.gz', '.json.zst')
+CODEC_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+ZSTD_DICT_FILE = 'rcan.zstd-dict'
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+
+# what reading a damaged or truncated document may raise: OSError (including gzip.BadGzipFile), EOFError for a
+# truncated gzip stream, zlib.error and zstandard.ZstdError for corrupt data
+READ_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def check_zstd():
+    if zstandard is None:
+        raise RuntimeError("The zstandard module is required for zstd compression (pip install zstandard).")
+
+
+def codec_of(file_name: str):
+    """
+    :return: 'gzip', 'zstd' or None, from the suffix of file_name.
+    """
+    if file_name.endswith('.gz'):
+        return 'gzip'
+    if file_name.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def parse_codec(name: str):
+    """
+    :param name: A codec name from the command line: gz, gzip, zst or zstd.
+    :return: The codec, None for an empty name.
+    """
+    codecs = {'gz': 'gzip', 'gzip': 'gzip', 'zst': 'zstd', 'zstd': 'zstd'}
+    if name and name not in codecs:
+        raise ValueError(f"Unknown compression {name}, expected gz or zst")
+    return codecs.get(name) if name else None
+
+
+def plain_name(file_name: str) -> str:
+    """
+    :return: file_name without its compression suffix, e.g. 123.json for 123.json.zst.
+    """
+    codec = codec_of(file_name)
+    return file_name[:-len(CODEC_SUFFIXES[codec])] if codec else file_name
+
+
+def compressed_name(file_name: str, codec) -> str:
+    """
+    :return: The name of file_name compressed with codec (None for no compression).
+    """
+    return plain_name(file_name) + (CODEC_SUFFIXES[codec] if codec else '')
+
+
+def compress(data: bytes, codec, dictionary=None, level: int = None) -> bytes:
+    if codec is None:
+        return data
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=level or GZIP_LEVEL, mtime=0)
+    return zstd_compressor(dictionary, level).compress(data)
+
+
+def decompress(data: bytes, codec, dictionary=None) -> bytes:
+    if codec is None:
+        return data
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    return zstd_decompressor(dictionary).decompress(data)
+
+
+def zstd_compressor(dictionary=None, level: int = None):
+    """
+    :return: A zstandard.ZstdCompressor, to compress many records with the same dictionary and level.
+    """
+    check_zstd()
+    return zstandard.ZstdCompressor(level=level or ZSTD_LEVEL, dict_data=dictionary)
+
+
+def zstd_decompressor(dictionary=None):
+    """
+    :return: A zstandard.ZstdDecompressor, to decompress many records with the same dictionary.
+    """
+    check_zstd()
+    return zstandard.ZstdDecompressor(dict_data=dictionary)
+
+
+def train_dictionary(samples: list, size: int = 112640):
+    """
+    :param samples: Documents (bytes) representative of the collection, a few thousands.
+    :param size: Maximum size of the dictionary, in bytes.
+    :return: A zstandard.ZstdCompressionDict.
+    """
+    check_zstd()
+    return zstandard.train_dictionary(size, samples)
+
+
+def sample_documents(source, nb_samples: int = 2000, seed: int = 0) -> list:
+    """
+    :return: The raw JSON of nb_samples documents of a collection source, drawn at random.
+    """
+    entries = source.entries()
+    entries = random.Random(seed).sample(entries, min(nb_samples, len(entries)))
+    result = []
+    for _, data in source.iter_raw(source.sort_entries(entries)):
+        if data is not None:
+            result.append(data)
+    return result
+
+
+def save_dictionary(dictionary, path: str):
+    with open(path + '.tmp', 'wb') as fout:
+        fout.write(dictionary.as_bytes())
+    os.replace(path + '.tmp', path)
+
+
+def load_dictionary(path: str):
+    """
+    :return: The zstd dictionary saved in path, None if there is none.
+    """
+    if not os.path.exists(path):
+        return None
+    check_zstd()
+    with open(path, 'rb') as fin:
+        return zstandard.ZstdCompressionDict(fin.read())
@@ -0,0 +1,169 @@
+"""
+Export of a collection to a columnar Parquet dataset, so that training jobs read the text and the themes of the
+documents without parsing their JSON and HTML again.
+
+The dataset is a directory partitioned by split, split=<name>/part-NNNNN.parquet, every part being a single row
+group written by one worker. Its columns are id, url, title, summary, paragraphs (the list returned by
+RDocument.extract_body_paragraphs), ThemeId, SubThemeIds, and the fields chosen at export time, JSON-encoded.
+A small manifest, _export.json, describes the export.
+
+(c) RALI, Université de Montréal.
+"""
+import os
+import sys
+
+import orjson
+
+from donnees import rcan_coll
+from donnees.rcan_coll import RCollection, RCollectionIt, read_ids, run_chunks
+
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_MANIFEST = '_export.json'
+EXPORT_VERSION = 1
+ALL_SPLIT = 'all'
+SPLIT_NAMES = ('train', 'valid', 'test')
+
+
+def _check_pyarrow():
+    if pyarrow is None:
+        raise RuntimeError("The pyarrow module is required for Parquet exports (pip install pyarrow).")
+
+
+def export_schema(fields=()):
+    _check_pyarrow()
+    return pyarrow.schema([('id', pyarrow.int64()), ('url', pyarrow.string()), ('title', pyarrow.string()),
+                           ('summary', pyarrow.string()), ('paragraphs', pyarrow.list_(pyarrow.string())),
+                           ('ThemeId', pyarrow.int32()), ('SubThemeIds', pyarrow.list_(pyarrow.int32()))] +
+                          [(x, pyarrow.string()) for x in fields])
+
+
+def split_files(split_dir: str) -> dict:
+    """
+    :param split_dir: A directory with the train.ids, valid.ids and test.ids files of create_rcan_split.py.
+    :return: A dict split name -> ids file, for the files that exist.
+    """
+    result = {}
+    for name in SPLIT_NAMES:
+        path = os.path.join(split_dir, name + '.ids')
+        if os.path.exists(path):
+            result[name] = path
+    return result
+
+
+def export_collection(coll: RCollection, out_dir: str, splits: dict = None, fields=(), workers: int = None,
+                      chunk_size: int = 2048, engine: str = 'lxml', compression: str = 'zstd') -> dict:
+    """
+    :param coll: The collection to export.
+    :param out_dir: The dataset directory, which must not exist or be empty.
+    :param splits: A dict split name -> ids file (see split_files). Only the documents of these splits are
+    exported. If None, all the documents are exported to the split 'all'.
+    :param fields: Other keys of the documents to export, as JSON-encoded string columns.
+    :param workers: Number of processes writing the parts.
+    :param chunk_size: Number of documents per part (and row group).
+    :param engine: Paragraph extraction engine, see RDocument.extract_body_paragraphs.
+    :param compression: Parquet compression codec.
+    :return: A dict split name -> number of documents exported.
+    """
+    _check_pyarrow()
+    if os.path.isdir(out_dir) and os.listdir(out_dir):
+        raise FileExistsError(f"{out_dir} is not empty")
+
+    source = coll.source
+    if splits is None:
+        split_entries = {ALL_SPLIT: source.entries()}
+    else:
+        split_entries = {name: source.sort_entries([source.locate(x) for x in read_ids(ids_file)])
+                         for name, ids_file in splits.items()}
+
+    def tasks():
+        for name, entries in split_entries.items():
+            os.makedirs(os.path.join(out_dir, f"split={name}"), exist_ok=True)
+            for part, i in enumerate(range(0, len(entries), chunk_size)):
+                yield name, part, entries[i:i + chunk_size]
+
+    args = (coll.col_spec, out_dir, tuple(fields), engine, compression)
+    nb_docs = dict.fromkeys(split_entries, 0)
+    nb_missing = 0
+    for name, nb_written, nb_failed in run_chunks(_export_chunk, args, tasks(), workers, ordered=False):
+        nb_docs[name] += nb_written
+        nb_missing += nb_failed
+
+    if nb_missing:
+        print(f"{nb_missing} documents could not be read", file=sys.stderr)
+
+    manifest = {'version': EXPORT_VERSION, 'collection': os.path.abspath(coll.col_spec), 'fields': list(fields),
+                'engine': engine, 'extractor_version': rcan_coll.EXTRACTOR_VERSION, 'splits': nb_docs}
+    with open(os.path.join(out_dir, EXPORT_MANIFEST), 'wb') as fout:
+        fout.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+    return nb_docs
+
+
+def _export_chunk(args, task):
+    col_spec, out_dir, fields, engine, compression = args
+    name, part, entries = task
+    coll = RCollection(col_spec)
+
+    columns = {x: [] for x in export_schema(fields).names}
+    nb_failed = 0
+    for doc in RCollectionIt(coll.source, entries):
+        if doc is None:
+            nb_failed += 1
+            continue
+
+        columns['id'].append(int(doc.id))
+        columns['url'].append(doc.url)
+        columns['title'].append(doc.title)
+        columns['summary'].append(doc.summary)
+        columns['paragraphs'].append(doc.extract_body_paragraphs(engine=engine))
+        theme = doc.get('ThemeId')
+        columns['ThemeId'].append(None if theme is None else int(theme))
+        columns['SubThemeIds'].append([int(x) for x in doc.get('SubThemeIds') or []])
+        for field in fields:
+            columns[field].append(orjson.dumps(doc[field]).decode('utf-8') if field in doc else None)
+
+    table = pyarrow.table(columns, schema=export_schema(fields))
+    path = os.path.join(out_dir, f"split={name}", f"part-{part:05d}.parquet")
+    pyarrow.parquet.write_table(table, path + '.tmp', row_group_size=max(1, len(entries)), compression=compression)
+    os.replace(path + '.tmp', path)
+    return name, table.num_rows, nb_failed
+
+
+def load_manifest(path: str) -> dict:
+    with open(os.path.join(path, EXPORT_MANIFEST), 'rb') as fin:
+        return orjson.loads(fin.read())
+
+
+def read_table(path: str, columns: list = None, splits: list = None):
+    """
+    Reads an exported dataset. Only the requested columns are read from the files.
+    :param path: The dataset directory.
+    :param columns: Column names, all of them if None. The partition column 'split' can be requested too.
+    :param splits: Split names to read, all of them if None.
+    :return: A pyarrow.Table.
+    """
+    _check_pyarrow()
+    dataset = pyarrow.dataset.dataset(path, format='parquet', partitioning='hive')
+    row_filter = None if splits is None else pyarrow.dataset.field('split').isin(list(splits))
+    return dataset.to_table(columns=columns, filter=row_filter)
+
+
+def read_columns(path: str, columns: list, splits: list = None) -> dict:
+    """
+    Same as read_table, as Python lists, with the exported fields decoded from JSON.
+    :return: A dict column name -> list of values, in the same document order for all columns.
+    """
+    table = read_table(path, columns, splits)
+    json_fields = set(load_manifest(path)['fields'])
+    result = {}
+    for name in table.column_names:
+        values = table.column(name).to_pylist()
+        if name in json_fields:
+            values = [None if x is None else orjson.loads(x) for x in values]
+        result[name] = values
+    return result
@@ -0,0 +1,129 @@
+"""
+Optional instrumentation of the collection pipeline: time spent per stage (read, decode, extract, write), bytes
+read and written, documents per second, failures by stage and exception, and memory high-water mark.
+
+Enable it with donnees.rcan_coll.set_instrumentation(Instrumentation(...)), or for any script by setting the
+environment variable RCAN_INSTRUMENT to a report interval in seconds, in which case a final summary is also
+written at exit. Reports are JSON lines written to stderr.
+
+(c) RALI, Université de Montréal.
+"""
+import collections
+import sys
+import time
+
+import orjson
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def max_rss_mb() -> float:
+    """
+    :return: The memory high-water mark of this process, in MB, 0 if unknown.
+    """
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    return usage.ru_maxrss / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+
+class Instrumentation:
+    """
+    Counters of a run. Workers of the process pools keep their own counters, merged into those of the parent
+    with every chunk of results.
+    """
+    def __init__(self, report_interval: float = None, stream=None):
+        """
+        :param report_interval: Seconds between periodic reports, no periodic report if None.
+        :param stream: Where reports are written, stderr if None.
+        """
+        self.report_interval = report_interval
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.next_report = self.start + report_interval if report_interval else None
+        self.nb_docs = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.stage_seconds = collections.Counter()
+        self.stage_calls = collections.Counter()
+        self.failures = collections.Counter()
+        self.worker_max_rss_mb = 0.0
+
+    def add(self, stage: str, seconds: float, nb_bytes: int = 0):
+        self.stage_seconds[stage] += seconds
+        self.stage_calls[stage] += 1
+        if stage == 'write':
+            self.bytes_written += nb_bytes
+        else:
+            self.bytes_read += nb_bytes
+
+    def fail(self, stage: str, error: BaseException):
+        self.failures[f"{stage}:{type(error).__name__}"] += 1
+
+    def time_call(self, stage: str, fn, *args):
+        """
+        :return: fn(*args), timed as stage. Exceptions are counted as failures of stage and raised again.
+        """
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        except Exception as e:
+            self.fail(stage, e)
+            raise
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def doc_done(self):
+        self.nb_docs += 1
+        self.maybe_report()
+
+    def maybe_report(self):
+        if self.next_report is not None:
+            now = time.perf_counter()
+            if now >= self.next_report:
+                self.next_report = now + self.report_interval
+                self.report()
+
+    def counters(self) -> dict:
+        """
+        :return: The counters as a picklable dict, see merge.
+        """
+        return {'docs': self.nb_docs, 'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+                'seconds': dict(self.stage_seconds), 'calls': dict(self.stage_calls),
+                'failures': dict(self.failures), 'max_rss_mb': max(self.worker_max_rss_mb, max_rss_mb())}
+
+    def merge(self, counters: dict):
+        """
+        Adds the counters of a worker, as returned by its counters().
+        """
+        self.bytes_read += counters['bytes_read']
+        self.bytes_written += counters['bytes_written']
+        self.stage_seconds.update(counters['seconds'])
+        self.stage_calls.update(counters['calls'])
+        self.failures.update(counters['failures'])
+        self.worker_max_rss_mb = max(self.worker_max_rss_mb, counters['max_rss_mb'])
+        self.nb_docs += counters['docs']
+        self.maybe_report()
+
+    def snapshot(self) -> dict:
+        elapsed = time.perf_counter() - self.start
+        return {'elapsed_s': round(elapsed, 3), 'docs': self.nb_docs,
+                'docs_per_s': round(self.nb_docs / elapsed, 1) if elapsed else 0.0,
+                'mb_read': round(self.bytes_read / (1 << 20), 3),
+                'mb_read_per_s': round(self.bytes_read / (1 << 20) / elapsed, 3) if elapsed else 0.0,
+                'mb_written': round(self.bytes_written / (1 << 20), 3),
+                'stages': {x: {'seconds': round(self.stage_seconds[x], 3), 'calls': self.stage_calls[x]}
+                           for x in sorted(self.stage_seconds)},
+                'failures': dict(self.failures),
+                'max_rss_mb': round(max_rss_mb(), 1), 'worker_max_rss_mb': round(self.worker_max_rss_mb, 1)}
+
+    def report(self, final: bool = False):
+        report = self.snapshot()
+        report['final'] = final
+        stream = self.stream or sys.stderr
+        stream.write(orjson.dumps(report).decode('utf-8') + '\n')
+        stream.flush()
@@ -0,0 +1,375 @@
+"""
+Near-duplicate detection over the article bodies: wire dispatches published by both sources, updated
+republications, etc.
+
+Every document gets a MinHash signature of the word shingles of its extracted paragraphs, computed in parallel.
+Signatures are cut into bands and hashed (locality sensitive hashing): documents sharing a band bucket are
+candidates, kept as duplicates when the Jaccard similarity estimated from their signatures reaches the threshold.
+Finding the candidates sorts every band once, so the clusters of a collection are found in O(n log n) instead of
+comparing all pairs. The index is saved next to the collection along with the signature of every entry (see
+coll_index.entry_signatures); when entries are added, removed or rewritten, only the new and modified ones are read
+again.
+
+(c) RALI, Université de Montréal.
+"""
+import os
+import re
+import sys
+import zlib
+
+import numpy
+
+from donnees.coll_index import changed_entries, entry_name, entry_signatures
+
+NEAR_DUP_VERSION = 2
+NUM_PERM = 128
+SHINGLE_SIZE = 5
+THRESHOLD = 0.8
+SEED = 1
+SIGNATURE_FIELDS = ['Lead', 'Body', 'BodyParagraphs']
+_EMPTY = numpy.uint32(0xFFFFFFFF)
+_SHINGLE_MULTIPLIER = numpy.uint64(0x9E3779B97F4A7C15)
+_BAND_MULTIPLIER = numpy.uint64(0x100000001B3)
+_HASH_BLOCK = 4096
+# members of a bucket are compared with this many members following them in the bucket: all pairs of the buckets up
+# to this size, a sliding window over the larger ones (boilerplate shared by many documents)
+_BUCKET_WINDOW = 64
+_WORD_RE = re.compile(r"\w+")
+
+
+def default_near_dup_path(col_spec: str, packed: bool) -> str:
+    """
+    :return: The near-duplicate index of a collection: inside a packed collection, next to a directory collection.
+    """
+    if packed:
+        return os.path.join(col_spec, 'rcan-near-dups.npz')
+    return os.path.normpath(col_spec) + '.rcan-near-dups.npz'
+
+
+def lsh_bands(num_perm: int, threshold: float) -> int:
+    """
+    :return: The number of bands of num_perm / bands rows for threshold: the one with the highest similarity
+    at which documents become likely candidates, (1 / bands) ** (rows / num_perm), below threshold, so that few
+    pairs above threshold are missed.
+    """
+    def likely_from(bands):
+        return (1 / bands) ** (bands / num_perm)
+
+    below = [x for x in range(1, num_perm + 1) if num_perm % x == 0 and likely_from(x) <= threshold]
+    return max(below, key=likely_from) if below else num_perm
+
+
+def permutations(num_perm: int, seed: int):
+    """
+    :return: (a, b), the coefficients of the num_perm hash functions (a * x + b) >> 32 of the signatures.
+    """
+    rng = numpy.random.default_rng(seed)
+    a = rng.integers(0, 2 ** 64, size=num_perm, dtype=numpy.uint64) | numpy.uint64(1)
+    b = rng.integers(0, 2 ** 64, size=num_perm, dtype=numpy.uint64)
+    return a, b
+
+
+def shingle_hashes(paragraphs: list, shingle_size: int = SHINGLE_SIZE) -> numpy.ndarray:
+    """
+    :param paragraphs: Text paragraphs, e.g. from RDocument.extract_body_paragraphs().
+    :return: The distinct 32-bit hashes of the shingles (runs of shingle_size lowercase words) of the text, a text
+    shorter than shingle_size words being one shingle.
+    """
+    words = _WORD_RE.findall(' '.join(paragraphs).lower())
+    if not words:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    word_hashes = numpy.fromiter((zlib.crc32(x.encode('utf-8')) for x in words), dtype=numpy.uint64,
+                                 count=len(words))
+    size = min(shingle_size, len(words))
+    nb_shingles = len(words) - size + 1
+    hashes = numpy.zeros(nb_shingles, dtype=numpy.uint64)
+    for i in range(size):
+        hashes = hashes * _SHINGLE_MULTIPLIER + word_hashes[i:i + nb_shingles]
+    return numpy.unique(hashes >> numpy.uint64(32))
+
+
+def minhash(hashes: numpy.ndarray, a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    """
+    :param hashes: Shingle hashes, see shingle_hashes.
+    :param a: First coefficients of the hash functions, see permutations.
+    :param b: Second coefficients.
+    :return: The signature, the minimum of every hash function over the shingles, as uint32. The signature of a
+    document without text is all 0xFFFFFFFF.
+    """
+    signature = numpy.full(len(a), _EMPTY, dtype=numpy.uint32)
+    for i in range(0, len(hashes), _HASH_BLOCK):
+        block = hashes[i:i + _HASH_BLOCK]
+        values = (a[:, None] * block[None, :] + b[:, None]) >> numpy.uint64(32)
+        numpy.minimum(signature, values.min(axis=1).astype(numpy.uint32), out=signature)
+    return signature
+
+
+def band_keys(signatures: numpy.ndarray, bands: int) -> numpy.ndarray:
+    """
+    :return: A (bands, n) array of uint64, the hash of every band of every signature.
+    """
+    rows = signatures.shape[1] // bands
+    keys = numpy.zeros((bands, len(signatures)), dtype=numpy.uint64)
+    for band in range(bands):
+        for column in signatures[:, band * rows:(band + 1) * rows].T:
+            keys[band] = (keys[band] ^ column.astype(numpy.uint64)) * _BAND_MULTIPLIER
+    return keys
+
+
+class NearDupIndex:
+    """
+    MinHash signatures of every entry of a collection, in arrays aligned with names, the entry names, and
+    entry_signatures, their signatures when they were read, and their LSH buckets: for every band, the band keys
+    sorted, and the entries in that order.
+    """
+    def __init__(self, names, entry_signatures, doc_ids, signatures, bands: int, threshold: float,
+                 shingle_size: int, seed: int):
+        self.names = names
+        self.entry_signatures = entry_signatures
+        self.doc_ids = doc_ids
+        self.signatures = signatures
+        self.bands = bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.seed = seed
+        self.empty = (signatures == _EMPTY).all(axis=1)
+        keys = band_keys(signatures, bands)
+        self.order = numpy.argsort(keys, axis=1, kind='stable')
+        self.sorted_keys = numpy.take_along_axis(keys, self.order, axis=1)
+
+    @property
+    def num_perm(self) -> int:
+        return self.signatures.shape[1]
+
+    def __len__(self):
+        return len(self.names)
+
+    def same_parameters(self, shingle_size: int, num_perm: int, seed: int) -> bool:
+        return (self.shingle_size, self.num_perm, self.seed) == (shingle_size, num_perm, seed)
+
+    def is_current(self, names: list, entry_signatures: list) -> bool:
+        """
+        :return: True if the index holds exactly the entries names, unchanged since they were read.
+        """
+        return self.names.tolist() == names and self.entry_signatures.tolist() == entry_signatures
+
+    def save(self, path: str):
+        with open(path + '.tmp', 'wb') as fout:
+            numpy.savez(fout, version=NEAR_DUP_VERSION, names=self.names, entry_signatures=self.entry_signatures,
+                        doc_ids=self.doc_ids, signatures=self.signatures, bands=self.bands,
+                        threshold=self.threshold, shingle_size=self.shingle_size, seed=self.seed)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def load(path: str):
+        """
+        :return: The saved index, or None when it does not exist or was saved by another version.
+        """
+        if not os.path.exists(path):
+            return None
+        with numpy.load(path) as data:
+            if int(data['version']) != NEAR_DUP_VERSION:
+                return None
+            return NearDupIndex(data['names'], data['entry_signatures'], data['doc_ids'], data['signatures'],
+                                int(data['bands']), float(data['threshold']), int(data['shingle_size']),
+                                int(data['seed']))
+
+    def similarities(self, left: numpy.ndarray, right: numpy.ndarray) -> numpy.ndarray:
+        """
+        :return: The Jaccard similarities of the entries left[i] and right[i], estimated from their signatures.
+        """
+        return (self.signatures[left] == self.signatures[right]).mean(axis=1)
+
+    def candidate_pairs(self) -> numpy.ndarray:
+        """
+        :return: A (n, 2) array of entry indexes (i < j) sharing at least one band bucket: all the pairs of the
+        buckets of up to _BUCKET_WINDOW documents, the pairs less than _BUCKET_WINDOW apart in the larger ones.
+        """
+        pairs = []
+        for keys, order in zip(self.sorted_keys, self.order):
+            keep = ~self.empty[order]
+            keys, order = keys[keep], order[keep]
+            for distance in range(1, min(_BUCKET_WINDOW, len(keys))):
+                same = keys[distance:] == keys[:-distance]
+                if not same.any():
+                    break
+                pairs.append(numpy.stack((order[:-distance][same], order[distance:][same]), axis=1))
+        if not pairs:
+            return numpy.zeros((0, 2), dtype=numpy.int64)
+        pairs = numpy.sort(numpy.concatenate(pairs), axis=1)
+        return numpy.unique(pairs, axis=0)
+
+    def duplicate_pairs(self, threshold: float = None) -> numpy.ndarray:
+        """
+        :param threshold: Minimum estimated Jaccard similarity, the one of the index if None.
+        :return: A (n, 2) array of the candidate pairs of entry indexes similar enough.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        pairs = self.candidate_pairs()
+        return pairs[self.similarities(pairs[:, 0], pairs[:, 1]) >= threshold]
+
+    def cluster_labels(self, threshold: float = None) -> numpy.ndarray:
+        """
+        :return: The cluster of every entry, the index of its member with the smallest doc id, by union-find over
+        the duplicate pairs (see duplicate_pairs).
+        """
+        pairs = self.duplicate_pairs(threshold)
+        # hook every entry to the smallest label of its pairs and compress the paths until nothing changes
+        labels = numpy.arange(len(self))
+        while True:
+            smallest = numpy.minimum(labels[pairs[:, 0]], labels[pairs[:, 1]])
+            hooked = labels.copy()
+            numpy.minimum.at(hooked, labels[pairs[:, 0]], smallest)
+            numpy.minimum.at(hooked, labels[pairs[:, 1]], smallest)
+            while True:
+                compressed = hooked[hooked]
+                if numpy.array_equal(compressed, hooked):
+                    break
+                hooked = compressed
+            if numpy.array_equal(hooked, labels):
+                break
+            labels = hooked
+
+        representatives = numpy.arange(len(self))
+        ids = numpy.where(self.doc_ids >= 0, self.doc_ids, numpy.iinfo(numpy.int64).max)
+        order = numpy.lexsort((ids, labels))
+        starts = numpy.concatenate(([True], labels[order][1:] != labels[order][:-1]))
+        representatives[labels[order[starts]]] = order[starts]
+        return representatives[labels]
+
+    def clusters(self, threshold: float = None, min_size: int = 2) -> list:
+        """
+        :return: The clusters of at least min_size documents, lists of doc ids starting with the representative
+        (the smallest id), largest clusters first.
+        """
+        labels = self.cluster_labels(threshold)
+        order = numpy.lexsort((self.doc_ids, labels))
+        sizes = numpy.bincount(labels, minlength=len(self))
+        bounds = numpy.flatnonzero(numpy.concatenate(([True], labels[order][1:] != labels[order][:-1], [True])))
+        result = [self.doc_ids[order[start:end]].tolist() for start, end in zip(bounds[:-1], bounds[1:])
+                  if sizes[labels[order[start]]] >= min_size]
+        result.sort(key=lambda x: (-len(x), x[0]))
+        return result
+
+    def representatives(self, threshold: float = None) -> dict:
+        """
+        :return: A dict doc id -> doc id of the representative of its cluster, for the documents having
+        near-duplicates.
+        """
+        labels = self.cluster_labels(threshold)
+        sizes = numpy.bincount(labels, minlength=len(self))
+        members = numpy.flatnonzero((sizes[labels] > 1) & (self.doc_ids >= 0))
+        return dict(zip(self.doc_ids[members].tolist(), self.doc_ids[labels[members]].tolist()))
+
+    def query(self, paragraphs: list, threshold: float = None) -> list:
+        """
+        Looks up the near-duplicates of a text, e.g. a document about to be annotated.
+        :param paragraphs: Text paragraphs, see shingle_hashes.
+        :return: A list of (doc id, estimated similarity) of the indexed documents similar enough, most similar
+        first.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        signature = minhash(shingle_hashes(paragraphs, self.shingle_size), *permutations(self.num_perm, self.seed))
+        if (signature == _EMPTY).all():
+            return []
+        keys = band_keys(signature[None, :], self.bands)[:, 0]
+        candidates = set()
+        for band, key in enumerate(keys):
+            start = numpy.searchsorted(self.sorted_keys[band], key, side='left')
+            end = numpy.searchsorted(self.sorted_keys[band], key, side='right')
+            candidates.update(self.order[band, start:end].tolist())
+        candidates = numpy.array(sorted(x for x in candidates if not self.empty[x]), dtype=numpy.int64)
+        if not len(candidates):
+            return []
+        similarities = (self.signatures[candidates] == signature).mean(axis=1)
+        keep = similarities >= threshold
+        return sorted(zip(self.doc_ids[candidates[keep]].tolist(), similarities[keep].tolist()),
+                      key=lambda x: (-x[1], x[0]))
+
+
+def build_near_dup_index(coll, workers: int = None, chunk_size: int = 256, threshold: float = THRESHOLD,
+                         num_perm: int = NUM_PERM, shingle_size: int = SHINGLE_SIZE, seed: int = SEED,
+                         previous: NearDupIndex = None, engine: str = 'lxml', entries: list = None,
+                         stamps: list = None) -> NearDupIndex:
+    """
+    Computes the signatures of the documents of coll, from their extracted paragraphs.
+    :param workers: Number of processes.
+    :param threshold: Estimated Jaccard similarity above which documents are near-duplicates, sets the LSH bands.
+    :param num_perm: Length of the signatures.
+    :param shingle_size: Number of words of the shingles.
+    :param previous: An index of an earlier state of the collection: the signatures of the entries it holds with the
+    same entry signature are reused when it was built with the same parameters.
+    :param engine: Paragraph extraction engine, see RDocument.extract_body_paragraphs.
+    :param entries: The entries of coll, read from its source if None.
+    :param stamps: Their entry signatures (see coll_index.entry_signatures), computed if None.
+    """
+    from donnees.rcan_coll import run_chunks
+
+    entries = coll.source.entries() if entries is None else entries
+    stamps = entry_signatures(coll.source, entries) if stamps is None else stamps
+    known = {}
+    if previous is not None and previous.same_parameters(shingle_size, num_perm, seed):
+        known = {x: (y, i) for i, (x, y) in enumerate(zip(previous.names.tolist(),
+                                                          previous.entry_signatures.tolist()))}
+    reused, chunks = changed_entries(entries, stamps, known, chunk_size)
+    doc_ids = numpy.full(len(entries), -1, dtype=numpy.int64)
+    signatures = numpy.full((len(entries), num_perm), _EMPTY, dtype=numpy.uint32)
+    for i, j in reused.items():
+        doc_ids[i], signatures[i] = previous.doc_ids[j], previous.signatures[j]
+
+    tasks = ([entries[x] for x in y] for y in chunks)
+    args = (coll.col_spec, shingle_size, num_perm, seed, engine)
+    for positions, (chunk_ids, chunk_signatures) in zip(chunks, run_chunks(_signature_chunk, args, tasks, workers)):
+        doc_ids[positions], signatures[positions] = chunk_ids, chunk_signatures
+    nb_failed = int((doc_ids < 0).sum())
+    if nb_failed:
+        print(f"{nb_failed} documents could not be read", file=sys.stderr)
+    return NearDupIndex(numpy.array([entry_name(x) for x in entries], dtype=str), numpy.array(stamps, dtype=str),
+                        doc_ids, signatures, lsh_bands(num_perm, threshold), threshold, shingle_size, seed)
+
+
+def _signature_chunk(args, entries):
+    from donnees.rcan_coll import RCollection, RCollectionIt
+
+    col_spec, shingle_size, num_perm, seed, engine = args
+    a, b = permutations(num_perm, seed)
+    source = RCollection(col_spec).source
+    doc_ids = []
+    signatures = numpy.full((len(entries), num_perm), _EMPTY, dtype=numpy.uint32)
+    for i, doc in enumerate(RCollectionIt(source, entries, SIGNATURE_FIELDS)):
+        if doc is None:
+            doc_ids.append(-1)
+            continue
+        doc_ids.append(int(doc.id))
+        signatures[i] = minhash(shingle_hashes(doc.extract_body_paragraphs(engine=engine), shingle_size), a, b)
+    return doc_ids, signatures
+
+
+def near_dup_index(coll, workers: int = None, path: str = None, threshold: float = THRESHOLD,
+                   num_perm: int = NUM_PERM, shingle_size: int = SHINGLE_SIZE, seed: int = SEED) -> NearDupIndex:
+    """
+    :param coll: An RCollection.
+    :param workers: Number of processes computing the signatures when the index is built.
+    :param path: The index file, see default_near_dup_path by default, e.g. a writable path for a collection on
+    a read-only mount.
+    :return: The near-duplicate index of coll, loaded, or built and saved if it is missing or stale, set for
+    threshold. When it cannot be saved, a warning is printed and the index is only kept in memory.
+    """
+    path = path or default_near_dup_path(coll.col_spec, coll.packed)
+    entries = coll.source.entries()
+    stamps = entry_signatures(coll.source, entries)
+    index = NearDupIndex.load(path)
+    if index is None or not index.same_parameters(shingle_size, num_perm, seed) or \
+            not index.is_current([entry_name(x) for x in entries], stamps):
+        index = build_near_dup_index(coll, workers, threshold=threshold, num_perm=num_perm,
+                                     shingle_size=shingle_size, seed=seed, previous=index, entries=entries,
+                                     stamps=stamps)
+        try:
+            index.save(path)
+        except OSError as e:
+            print(f"Could not save the near-duplicate index to {path} ({e}), using it in memory", file=sys.stderr)
+    elif index.bands != lsh_bands(num_perm, threshold):
+        index = NearDupIndex(index.names, index.entry_signatures, index.doc_ids, index.signatures,
+                             lsh_bands(num_perm, threshold), threshold, shingle_size, seed)
+    index.threshold = threshold
+    return index
@@ -0,0 +1,180 @@
+"""
+Streaming readers and writers for theme prediction files.
+
+Two formats are supported: the original one, a single JSON object mapping doc ids to predictions
+({"123": {"theme": [[id, score], ...], "sub_themes": [...]}, ...}), and JSON Lines, one
+{"id": 123, "theme": [...], "sub_themes": [...]} object per line, for files whose name ends with .jsonl.
+
+(c) RALI, Université de Montréal.
+"""
+import heapq
+import itertools
+import json
+import os
+import tempfile
+
+import orjson
+
+_CHUNK_SIZE = 1 << 20
+_WHITESPACE = ' \t\n\r'
+
+
+def iter_predictions(path: str):
+    """
+    Reads a prediction file incrementally, in constant memory.
+    :return: An iterator over (doc_id, predictions), in file order. doc_id is a str for the original format.
+    """
+    if path.endswith('.jsonl'):
+        return _iter_jsonl(path)
+    return _iter_json_object(path)
+
+
+def _iter_jsonl(path):
+    with open(path, 'rb') as fin:
+        for line in fin:
+            if line.strip():
+                info = orjson.loads(line)
+                yield info.pop('id'), info
+
+
+def _iter_json_object(path):
+    """Yields the members of the top-level object of a JSON file, decoding one member at a time."""
+    decoder = json.JSONDecoder()
+
+    with open(path, 'r', encoding='utf-8') as fin:
+        buf = ''
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buf, pos, eof
+            chunk = fin.read(_CHUNK_SIZE)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            return not eof
+
+        def skip_whitespace():
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in _WHITESPACE:
+                    pos += 1
+                if pos < len(buf) or not fill():
+                    return
+
+        def expect(char):
+            nonlocal pos
+            skip_whitespace()
+            if pos >= len(buf) or buf[pos] != char:
+                raise ValueError(f"Invalid prediction file {path}: expected '{char}'")
+            pos += 1
+
+        def decode_value():
+            nonlocal pos
+            skip_whitespace()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # a number at the end of the buffer may be truncated
+                    if end < len(buf) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        expect('{')
+        skip_whitespace()
+        if pos < len(buf) and buf[pos] == '}':
+            return
+
+        while True:
+            key = decode_value()
+            expect(':')
+            yield key, decode_value()
+
+            skip_whitespace()
+            if pos < len(buf) and buf[pos] == ',':
+                pos += 1
+            else:
+                expect('}')
+                return
+
+
+def doc_id_key(doc_id) -> int:
+    """Sort key of doc ids, which are ints or int strings."""
+    return int(doc_id)
+
+
+def write_jsonl(items, path: str):
+    """
+    Writes (doc_id, predictions) pairs in the JSON Lines format.
+    """
+    with open(path, 'wb', buffering=_CHUNK_SIZE) as fout:
+        for doc_id, info in items:
+            fout.write(orjson.dumps(dict(info, id=doc_id_key(doc_id))))
+            fout.write(b'\n')
+
+
+def is_sorted(path: str) -> bool:
+    """
+    :return: True if the doc ids of a prediction file are strictly increasing.
+    """
+    previous = None
+    for doc_id, _ in iter_predictions(path):
+        key = doc_id_key(doc_id)
+        if previous is not None and key <= previous:
+            return False
+        previous = key
+    return True
+
+
+def sort_to_jsonl(src: str, dst: str, run_size: int = 200000):
+    """
+    Converts a prediction file to JSON Lines sorted by doc id, with an external merge sort: at most run_size
+    predictions are held in memory.
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(dst))) as tmp_dir:
+        run_files = []
+        items = iter_predictions(src)
+        while True:
+            run = list(itertools.islice(items, run_size))
+            if not run:
+                break
+            run.sort(key=lambda x: doc_id_key(x[0]))
+            run_files.append(os.path.join(tmp_dir, f"run-{len(run_files)}.jsonl"))
+            write_jsonl(run, run_files[-1])
+
+        write_jsonl(heapq.merge(*[_iter_jsonl(x) for x in run_files], key=lambda x: x[0]), dst)
+
+
+def merge_predictions(paths: list, tmp_dir: str = None):
+    """
+    Merges several prediction files in a single streaming pass keyed by doc id. Files that are not sorted by doc
+    id are first sorted into temporary JSON Lines files.
+
+    :param paths: Prediction files.
+    :param tmp_dir: Where to sort unsorted files, the system temporary directory if None.
+    :return: An iterator over (doc_id, [predictions of every file, None when a file has no prediction for the
+    doc]), sorted by int doc id.
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as sort_dir:
+        streams = []
+        for i, path in enumerate(paths):
+            if not is_sorted(path):
+                sorted_path = os.path.join(sort_dir, f"sorted-{i}.jsonl")
+                sort_to_jsonl(path, sorted_path)
+                path = sorted_path
+            streams.append(_keyed_stream(path, i))
+
+        for doc_id, group in itertools.groupby(heapq.merge(*streams), key=lambda x: x[0]):
+            infos = [None] * len(paths)
+            for _, i, info in group:
+                infos[i] = info
+            yield doc_id, infos
+
+
+def _keyed_stream(path, file_idx):
+    for doc_id, info in iter_predictions(path):
+        yield doc_id_key(doc_id), file_idx, info
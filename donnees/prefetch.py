@@ -0,0 +1,94 @@
+"""
+Read-ahead of collection records on a thread pool, to hide the latency of network filesystems.
+
+(c) RALI, Université de Montréal.
+"""
+import collections
+import concurrent.futures
+import os
+import sys
+import threading
+
+from donnees.compression import READ_ERRORS
+
+PREFETCH_MAX_BYTES = 64 << 20
+NETWORK_FS_TYPES = {'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'lustre', 'gpfs', 'beegfs', 'glusterfs',
+                    'ceph', 'fuse.sshfs', 'fuse.glusterfs', 'fuse.cephfs', '9p'}
+
+
+def filesystem_type(path: str):
+    """
+    :return: The type of the filesystem holding path, from /proc/mounts, None when unknown (e.g. not on Linux).
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    path = os.path.realpath(path)
+    best_mount, best_type = '', None
+    try:
+        with open('/proc/mounts', 'r', encoding='utf-8') as fin:
+            for line in fin:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mount = parts[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) >= len(best_mount):
+                    best_mount, best_type = mount, parts[2]
+    except OSError:
+        return None
+    return best_type
+
+
+def is_network_path(path: str) -> bool:
+    return filesystem_type(path) in NETWORK_FS_TYPES
+
+
+def prefetch_raw(source, entries=None, threads: int = 8, max_bytes: int = PREFETCH_MAX_BYTES):
+    """
+    Same as source.iter_raw(entries), with the records read ahead of the consumer by a pool of threads. Reads stop
+    being issued while the records read but not yet consumed hold more than max_bytes.
+
+    :param source: A collection source, e.g. DirectorySource or PackedSource.
+    :param entries: The entries to read, all of them if None.
+    :param threads: Number of reading threads.
+    :return: An iterator over (entry, raw bytes), in the order of entries. raw bytes is None when the record could
+    not be read or decompressed.
+    """
+    entries = source.entries() if entries is None else entries
+    lock = threading.Lock()
+    buffered = 0
+
+    def read(entry):
+        nonlocal buffered
+        try:
+            data = source.read(entry)
+        except READ_ERRORS:
+            return None
+        with lock:
+            buffered += len(data)
+        return data
+
+    max_pending = 4 * threads
+    entry_it = iter(entries)
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < max_pending and buffered < max_bytes:
+                    entry = next(entry_it, None)
+                    if entry is None:
+                        exhausted = True
+                    else:
+                        pending.append((entry, executor.submit(read, entry)))
+                if not pending:
+                    return
+
+                entry, future = pending.popleft()
+                data = future.result()
+                if data is not None:
+                    with lock:
+                        buffered -= len(data)
+                yield entry, data
+        finally:
+            for _, future in pending:
+                future.cancel()
@@ -4,81 +4,518 @@ Atelier de résolution de problèmes industriels 2019.
 (c) RALI, Université de Montréal.
 Fabrizio Gotti - gottif.
 """
+import collections
+import concurrent.futures
+import pickle
+import random
 import sys
+import types
 
 from bs4 import BeautifulSoup
-import lxml
+import atexit
+import lxml.etree
 import orjson
 import os
+import time
+
+from donnees import coll_index, compression, rcan_pack
+from donnees.cache import SQLiteLRUCache, content_key
+from donnees.instrument import Instrumentation
+from donnees.prefetch import prefetch_raw
 
-_theme_dict = {}
-_subtheme_dict = {}
 _res_path = os.path.dirname(os.path.realpath(__file__)) + os.path.sep + 'resources'
+_RESOURCE_FILES = ('themes.tsv', 'subthemes.tsv', 'theme_soustheme_relationship.json')
+RESOURCE_SNAPSHOT = os.path.join(_res_path, 'resources.pickle')
+
+# the theme registry, loaded on first use by resources(). Workers forked after it is loaded share it.
+_resources = None
+
+# bump when the output of _extract_body_paragraphs changes, to invalidate persistent paragraph caches
+EXTRACTOR_VERSION = 3
+
+# the persistent paragraph cache, see set_paragraph_cache. Defaults to the SQLite file named by the
+# RCAN_PARAGRAPH_CACHE environment variable, if any.
+_paragraph_cache = None
+if os.environ.get('RCAN_PARAGRAPH_CACHE'):
+    _paragraph_cache = SQLiteLRUCache(os.environ['RCAN_PARAGRAPH_CACHE'])
+
+# the instrumentation of the pipeline, see set_instrumentation. Enabled by the RCAN_INSTRUMENT environment
+# variable, the interval between reports in seconds.
+_instrumentation = None
+if os.environ.get('RCAN_INSTRUMENT'):
+    _instrumentation = Instrumentation(float(os.environ['RCAN_INSTRUMENT']) or None)
+    atexit.register(lambda: _instrumentation is not None and _instrumentation.report(final=True))
 
 
 class RCollection:
     def __init__(self, col_spec: str):
         """
-        :param col_spec: A path containing the JSon files of the collection.
+        :param col_spec: A path containing the JSon files of the collection, or a packed collection
+        (see donnees.rcan_pack).
         """
         if not os.path.exists(col_spec):
             raise ValueError(f"Invalid directory {col_spec}")
 
         self.col_spec = col_spec
+        self.packed = rcan_pack.is_packed(col_spec)
+        self.source = _open_source(col_spec)
+        self._index = None
 
-    def find(self):
+    def find(self, workers: int = None, chunk_size: int = 256, ordered: bool = True, fields=None,
+             sample: int = None, seed=None, where: dict = None, prefetch: int = None, index_path: str = None):
         """
+        :param workers: When > 1, files are read and decoded by this many processes.
+        :param chunk_size: Number of documents handed to a worker at a time.
+        :param ordered: In parallel mode, return documents in collection order (True) or as soon as they are
+        decoded (False).
+        :param fields: If given, a list of keys: only these keys (and the few keys RDocument needs) are kept once
+        the document is decoded. Other keys are decoded again from the raw JSON on first access.
+        :param sample: If given, only this many documents drawn at random without replacement are returned.
+        :param seed: Seed of the random sample.
+        :param where: If given, a dict of conditions on ThemeId, SubThemeIds, the source, IsDispatch or the publish
+        date (see CollectionIndex.match). Only the matching documents are read, using the index of the collection,
+        which is built the first time.
+        :param prefetch: If given, the number of threads reading documents ahead of their decoding (in every
+        worker in parallel mode), to hide the latency of network filesystems.
+        :param index_path: The index file used with where, see index().
         :return: An iterator over the whole collection. Returns an RDocument object for every document in the
         collection.
         """
-        class RCollectionIt:
-            def __init__(self, directory):
-                self.dir = directory
-                self.scan_it = os.scandir(self.dir)
-
-            def __iter__(self):
-                return self
+        if not workers or workers <= 1:
+            entries = None
+            if sample is not None or where is not None:
+                entries = self._entries(sample, seed, where, index_path)
+            return RCollectionIt(self.source, entries, fields, prefetch)
+
+        chunks = self._chunks(chunk_size, sample, seed, where, index_path)
+        args = (self.col_spec, fields, prefetch)
+        return _flatten(run_chunks(_find_chunk, args, chunks, workers, ordered))
+
+    def map_reduce(self, mapper, reducer, workers: int = None, chunk_size: int = 256, ordered: bool = False,
+                   fields=None, sample: int = None, seed=None, where: dict = None, prefetch: int = None,
+                   index_path: str = None):
+        """
+        Runs mapper over chunks of the collection, in parallel, and merges the partial results with reducer.
+        Documents that cannot be read are skipped. Both functions must be picklable (module-level).
+
+        :param mapper: A function taking an iterable of RDocument and returning a partial result.
+        :param reducer: An associative function merging two partial results into one.
+        :param workers: Number of processes, runs in this process when None or 1.
+        :param chunk_size: Number of documents handed to mapper at a time in parallel mode.
+        :param ordered: Merge partial results in collection order, needed only when reducer is not commutative.
+        :param fields: Keys to keep in the documents, see find().
+        :param sample: Number of documents drawn at random, see find().
+        :param seed: Seed of the random sample.
+        :param where: Conditions on the documents, see find().
+        :param prefetch: Number of threads reading documents ahead, see find().
+        :param index_path: The index file used with where, see index().
+        :return: The merged result, None for an empty collection.
+        """
+        if not workers or workers <= 1:
+            docs = self.find(fields=fields, sample=sample, seed=seed, where=where, prefetch=prefetch,
+                             index_path=index_path)
+            return mapper(x for x in docs if x is not None)
+
+        result = None
+        first = True
+        args = (self.col_spec, mapper, fields, prefetch)
+        chunks = self._chunks(chunk_size, sample, seed, where, index_path)
+        for partial in run_chunks(_map_chunk, args, chunks, workers, ordered):
+            result = partial if first else reducer(result, partial)
+            first = False
+        return result
 
-            def __next__(self):
-                next_file_entry = next(self.scan_it)
-                next_file = os.path.join(self.dir, next_file_entry.name)
+    def decode(self, entry, data: bytes, fields=None):
+        """
+        :param entry: An entry of self.source.
+        :param data: The raw JSON of the entry, as returned by self.source.read(entry).
+        :param fields: Keys to keep in the document, see find().
+        :return: The RDocument.
+        """
+        return _make_document(self.source.source_file(entry), data, fields)
 
-                doc = None
+    def index(self, workers: int = None, path: str = None) -> coll_index.CollectionIndex:
+        """
+        :param workers: Number of processes reading the documents when the index is built.
+        :param path: The index file, see coll_index.default_index_path by default, e.g. a writable path for a
+        collection on a read-only mount.
+        :return: The secondary index of the collection, loaded, or built and saved if it is missing, and updated
+        and saved if entries were added, removed or rewritten since it was saved. When it cannot be saved, a
+        warning is printed and the index is only kept in memory.
+        """
+        if self._index is None:
+            path = path or coll_index.default_index_path(self.col_spec, self.packed)
+            entries = self.source.entries()
+            names = [coll_index.entry_name(x) for x in entries]
+            signatures = coll_index.entry_signatures(self.source, entries)
+            self._index = coll_index.CollectionIndex.load(path)
+            if self._index is None or not self._index.is_current(names, signatures):
+                self._index = coll_index.build_index(self, workers, previous=self._index, entries=entries,
+                                                     signatures=signatures)
                 try:
-                    result = orjson.loads(open(next_file, 'r', encoding='utf-8').read())
-                    result['source_file'] = next_file
-                    doc = RDocument(result)
-                except:
-                    print("Problem reading file " + next_file)
+                    self._index.save(path)
+                except OSError as e:
+                    print(f"Could not save the index to {path} ({e}), using it in memory", file=sys.stderr)
+        return self._index
+
+    def _entries(self, sample=None, seed=None, where=None, index_path=None):
+        entries = self.source.entries()
+        if where is not None:
+            matching = set(self.index(path=index_path).match_names(where))
+            entries = [x for x in entries if coll_index.entry_name(x) in matching]
+        if sample is not None and sample < len(entries):
+            entries = self.source.sort_entries(random.Random(seed).sample(entries, sample))
+        return entries
+
+    def _chunks(self, chunk_size, sample=None, seed=None, where=None, index_path=None):
+        entries = self._entries(sample, seed, where, index_path)
+        for i in range(0, len(entries), chunk_size):
+            yield entries[i:i + chunk_size]
+
+    def get(self, doc_id, fields=None):
+        """
+        :param doc_id: A document id (int or str).
+        :param fields: Keys to keep in the document, see find().
+        :return: The RDocument with this id. Raises KeyError if the collection does not contain it.
+        """
+        entry = self.source.locate(doc_id)
+        try:
+            data = self.source.read(entry)
+        except FileNotFoundError:
+            raise KeyError(doc_id)
+        return _make_document(self.source.source_file(entry), data, fields)
+
+    def get_many(self, ids, fields=None):
+        """
+        Fetches several documents, reading them in physical order rather than in the order of ids.
+
+        :param ids: An iterable of document ids. Raises KeyError if one of them is not in the collection.
+        :param fields: Keys to keep in the documents, see find().
+        :return: An iterator over RDocument objects, in physical order.
+        """
+        entries = self.source.sort_entries([self.source.locate(x) for x in ids])
+        for entry, data in self.source.iter_raw(entries):
+            if data is None:
+                raise KeyError(entry)
+            yield _make_document(self.source.source_file(entry), data, fields)
+
+
+def read_ids(ids_file: str) -> list:
+    """
+    Reads a file with one document id per line, like the split files written by create_rcan_split.py.
+    :return: A list of int ids.
+    """
+    with open(ids_file, 'r', encoding='utf-8') as fin:
+        return [int(x) for x in fin if x.strip()]
+
+
+def _open_source(col_spec):
+    return rcan_pack.PackedSource(col_spec) if rcan_pack.is_packed(col_spec) else DirectorySource(col_spec)
+
+
+_worker_sources = {}
+
+
+def _worker_source(col_spec):
+    """One source per collection and per worker process, so pack indexes are loaded once."""
+    source = _worker_sources.get(col_spec)
+    if source is None:
+        source = _worker_sources[col_spec] = _open_source(col_spec)
+    return source
+
+
+def _find_chunk(args, entries):
+    col_spec, fields, prefetch = args
+    return list(RCollectionIt(_worker_source(col_spec), entries, fields, prefetch))
+
+
+def _map_chunk(args, entries):
+    col_spec, mapper, fields, prefetch = args
+    docs = RCollectionIt(_worker_source(col_spec), entries, fields, prefetch)
+    return mapper(x for x in docs if x is not None)
+
+
+def _run_chunk(fn, arg, chunk, instrumented):
+    """
+    Runs fn(arg, chunk) in a worker.
+    :return: (result, counters of the instrumentation or None).
+    """
+    # every chunk is counted from zero in the worker, its counters are merged in the parent. The instrumentation
+    # inherited from the parent, or created at import from RCAN_INSTRUMENT, would report on its own.
+    global _instrumentation
+    _instrumentation = Instrumentation() if instrumented else None
+    try:
+        result = fn(arg, chunk)
+        return result, None if _instrumentation is None else _instrumentation.counters()
+    finally:
+        _instrumentation = None
+
+
+def _merge_counters(results):
+    for result, counters in results:
+        if counters is not None and _instrumentation is not None:
+            _instrumentation.merge(counters)
+        yield result
+
+
+def run_chunks(fn, arg, chunks, workers, ordered=True):
+    """
+    Runs fn(arg, chunk) for every chunk on a process pool, keeping at most 2 chunks per worker in flight so that
+    memory stays bounded whatever the speed of the consumer. fn and arg must be picklable. When the
+    instrumentation is enabled, what the workers count is added to the instrumentation of this process.
+    :param workers: Number of processes, runs in this process when None or 1.
+    :return: An iterator over the results, in chunk order if ordered.
+    """
+    if not workers or workers <= 1:
+        for chunk in chunks:
+            yield fn(arg, chunk)
+        return
+
+    instrumented = _instrumentation is not None
+    max_pending = 2 * workers
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque() if ordered else set()
+        for chunk in chunks:
+            if len(pending) >= max_pending:
+                yield from _merge_counters(_pop_done(pending, ordered))
+            future = executor.submit(_run_chunk, fn, arg, chunk, instrumented)
+            if ordered:
+                pending.append(future)
+            else:
+                pending.add(future)
+
+        while pending:
+            yield from _merge_counters(_pop_done(pending, ordered))
 
-                return doc
 
-        return RCollectionIt(self.col_spec)
+def _pop_done(pending, ordered):
+    if ordered:
+        yield pending.popleft().result()
+    else:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+            yield future.result()
+
+
+def _flatten(chunk_results):
+    for docs in chunk_results:
+        yield from docs
+
+
+def _make_document(source_file, data, fields=None):
+    result = orjson.loads(data)
+    result['source_file'] = source_file
+    if fields is None:
+        return RDocument(result)
+
+    projection = {k: result[k] for k in _REQUIRED_KEYS}
+    for key in fields:
+        if key in result:
+            projection[key] = result[key]
+    return RDocument(projection, data, _key_set(result))
+
+
+_key_sets = {}
+
+
+def _key_set(dictionary: dict) -> frozenset:
+    """
+    :return: The keys of dictionary, as a frozenset shared by the documents with the same keys.
+    """
+    keys = tuple(dictionary)
+    result = _key_sets.get(keys)
+    if result is None:
+        result = frozenset(keys)
+        if len(_key_sets) < 1024:
+            _key_sets[keys] = result
+    return result
+
+
+class DirectorySource:
+    """
+    Reads raw records from a directory holding one JSON file per document, possibly compressed (see
+    donnees.compression).
+    """
+    def __init__(self, directory: str):
+        self.dir = directory
+        self._dictionary = None
+        self._dictionary_loaded = False
+        self._suffix = '.json'
+
+    def entries(self) -> list:
+        """
+        :return: The file names of the collection, in directory order.
+        """
+        return list(self.scan_names())
+
+    def source_file(self, entry: str) -> str:
+        return os.path.join(self.dir, entry)
+
+    def locate(self, doc_id) -> str:
+        """
+        Documents of a directory collection are stored in files named after their id, so the directory itself
+        serves as the id index.
+        :return: The file name of document doc_id, <id>.json if there is no file for it.
+        """
+        # files are usually all compressed the same way: the suffix found last is tried first
+        for suffix in (self._suffix,) + compression.DOC_SUFFIXES:
+            name = str(doc_id) + suffix
+            if os.path.exists(os.path.join(self.dir, name)):
+                self._suffix = suffix
+                return name
+        return str(doc_id) + '.json'
+
+    def sort_entries(self, entries: list) -> list:
+        return sorted(entries)
+
+    def signature(self, entry: str) -> str:
+        """
+        :return: A string that changes when the file of entry is modified, without reading it.
+        """
+        stat = os.stat(os.path.join(self.dir, entry))
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def read(self, entry: str) -> bytes:
+        """
+        :return: The raw JSON of entry, decompressed.
+        """
+        with open(os.path.join(self.dir, entry), 'rb') as fin:
+            data = fin.read()
+        codec = compression.codec_of(entry)
+        if codec == 'zstd' and not self._dictionary_loaded:
+            self._dictionary = compression.load_dictionary(os.path.join(self.dir, compression.ZSTD_DICT_FILE))
+            self._dictionary_loaded = True
+        return compression.decompress(data, codec, self._dictionary)
+
+    def iter_raw(self, entries=None):
+        """
+        :param entries: The file names to read, all of them if None.
+        :return: An iterator over (entry, raw bytes). raw bytes is None when the file could not be read or
+        decompressed.
+        """
+        for entry in (self.scan_names() if entries is None else entries):
+            try:
+                data = self.read(entry)
+            except compression.READ_ERRORS:
+                data = None
+            yield entry, data
+
+    def scan_names(self):
+        with os.scandir(self.dir) as scan_it:
+            for file_entry in scan_it:
+                if file_entry.name.endswith(compression.DOC_SUFFIXES):
+                    yield file_entry.name
+
+
+class RCollectionIt:
+    """
+    Iterates over the raw records of a source and decodes them into RDocument objects.
+    """
+    def __init__(self, source, entries=None, fields=None, prefetch: int = None):
+        """
+        :param prefetch: If given, the number of threads reading records ahead, see donnees.prefetch.
+        """
+        self.source = source
+        self.fields = fields
+        self.raw_it = prefetch_raw(source, entries, prefetch) if prefetch else source.iter_raw(entries)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if _instrumentation is not None:
+            return self._next_instrumented(_instrumentation)
+
+        entry, data = next(self.raw_it)
+        next_file = self.source.source_file(entry)
+
+        doc = None
+        try:
+            doc = _make_document(next_file, data, self.fields)
+        except:
+            print("Problem reading file " + next_file)
+
+        return doc
+
+    def _next_instrumented(self, instr):
+        start = time.perf_counter()
+        entry, data = next(self.raw_it)
+        decode_start = time.perf_counter()
+        instr.add('read', decode_start - start, len(data) if data is not None else 0)
+        next_file = self.source.source_file(entry)
+
+        doc = None
+        if data is None:
+            instr.fail('read', OSError())
+            print("Problem reading file " + next_file)
+        else:
+            try:
+                doc = _make_document(next_file, data, self.fields)
+            except Exception as e:
+                instr.fail('decode', e)
+                print("Problem reading file " + next_file)
+            instr.add('decode', time.perf_counter() - decode_start)
+
+        instr.doc_done()
+        return doc
+
+
+_REQUIRED_KEYS = ('_id', 'SearchableTitle', 'SearchableSummary', 'FirstPublishedCanonicalWebLink', 'source_file')
 
 
 class RDocument:
     """
     A few utilities to manipulate documents.
     """
+    __slots__ = ('_d', '_raw', '_keys', '_subthemes', 'id', 'summary', 'title', 'url')
     id: str
     summary: str
     title: str
     url: str
 
-    def __init__(self, dictionary: dict):
+    def __init__(self, dictionary: dict, raw: bytes = None, keys: frozenset = None):
+        """
+        :param dictionary: The decoded JSON of the document, possibly restricted to a few keys.
+        :param raw: The raw JSON of the whole document, decoded again on the first access to a key missing
+        from dictionary. None when dictionary is complete.
+        :param keys: With raw, all the keys of the document, so that missing keys are known without decoding it.
+        """
         self._d = dictionary
+        self._raw = raw
+        self._keys = keys
+        self._subthemes = None
         self.id = self._d['_id']
         self.title = self._d['SearchableTitle']
         self.summary = self._d['SearchableSummary']
         self.url = self._d['FirstPublishedCanonicalWebLink']
 
     def __getitem__(self, item):
+        if self._raw is not None and item not in self._d and self._has_key(item):
+            self._decode_all()
         return self._d[item]
 
     def __contains__(self, item):
+        if self._raw is not None and item not in self._d:
+            if not self._has_key(item):
+                return False
+            self._decode_all()
         return item in self._d
 
-    def extract_body_paragraphs(self) -> list:
+    def _has_key(self, item) -> bool:
+        return self._keys is None or item in self._keys
+
+    def get(self, item, default=None):
+        return self[item] if item in self else default
+
+    def _decode_all(self):
+        full = orjson.loads(self._raw)
+        full.update(self._d)
+        self._d = full
+        self._raw = None
+        self._keys = None
+
+    def extract_body_paragraphs(self, cache=None, engine: str = 'bs4') -> list:
         """
         Returns the concatenation of the lead and the body of the article, after parsing html to get text. Some
         extraneous content may be found in the result since the body contains numerous heterogeneous elements,
@@ -86,109 +523,395 @@ class RDocument:
         but does include section headers.
 
         When the field BodyParagraphs is present in the underlying JSON, will simply return this value, otherwise
-        will perform the extraction per se, which is much slower.
+        will perform the extraction per se, which is much slower, unless the result is found in the persistent
+        paragraph cache.
 
+        :param cache: A paragraph cache (any object with get(key) and put(key, value) methods, see
+        donnees.cache.SQLiteLRUCache), overrides the one set with set_paragraph_cache.
+        :param engine: 'bs4' parses the html with BeautifulSoup, 'lxml' walks the lxml tree directly. Both give the
+        same paragraphs, 'lxml' is several times faster.
         :return: A list of text paragraphs (strings).
         """
 
-        if 'BodyParagraphs' in self._d:
+        if 'BodyParagraphs' in self:
             result = self._d['BodyParagraphs']
         else:
-            result = self._extract_body_paragraphs()
+            cache = _paragraph_cache if cache is None else cache
+            if cache is None:
+                result = run_stage('extract', self._extract_body_paragraphs, engine)
+            else:
+                key = self.paragraph_cache_key(engine)
+                result = cache.get(key)
+                if result is None:
+                    result = run_stage('extract', self._extract_body_paragraphs, engine)
+                    cache.put(key, result)
 
             # cache result
             self._d['BodyParagraphs'] = result
 
         return result
 
-    def _extract_body_paragraphs(self):
+    def paragraph_cache_key(self, engine: str = 'bs4') -> str:
+        """
+        :param engine: The extraction engine, see extract_body_paragraphs.
+        :return: The key of this document in a paragraph cache: changes with the id, the lead, the body, the
+        extraction engine and the extractor version.
+        """
+        return content_key(self.id, EXTRACTOR_VERSION, engine, self.get('Lead', ''), self.get('Body', ''))
+
+    def _extract_body_paragraphs(self, engine: str = 'bs4'):
         # guess the document type
         ledevoirdoc = 'ledevoir' in self.url
 
         # create an html of the full document, then parse
-        full_html = '<div>' + self._d.get('Lead', '') + '</div> \n<div>' + self._d.get('Body', '') + '</div>'
-        soup = BeautifulSoup(full_html, "lxml")
+        full_html = '<div>' + self.get('Lead', '') + '</div> \n<div>' + self.get('Body', '') + '</div>'
+
+        if engine == 'lxml':
+            text = _lxml_text(full_html, _LEDEVOIR_REMOVED if ledevoirdoc else _RADIOCAN_REMOVED)
+        elif engine == 'bs4':
+            soup = BeautifulSoup(full_html, "lxml")
+
+            if ledevoirdoc:
+                # remove
+                for n in soup.select('script, noscript, style'):
+                    n.decompose()
+            else:  # radio-canada
+                # remove copyright holders in figures, scripts, styles
+                for n in soup.select('span.creator, span.copyrightHolder, script, noscript, style'):
+                    n.decompose()
+            text = soup.get_text()
+        else:
+            raise ValueError(f"Unknown extraction engine {engine}")
 
+        # create text version
         if ledevoirdoc:
-            # remove
-            for n in soup.select('script, noscript, style'):
-                n.decompose()
-            # create text version
-            result = [x.strip() for x in soup.get_text().split('\n') if len(x.strip()) > 1]
-        else:  # radio-canada
-            # remove copyright holders in figures, scripts, styles
-            for n in soup.select('span.creator, span.copyrightHolder, script, noscript, style'):
-                n.decompose()
-            # create text version
-            result = [x for x in soup.get_text().split('\n') if len(x.strip()) > 1]
+            result = [x.strip() for x in text.split('\n') if len(x.strip()) > 1]
+        else:
+            result = [x for x in text.split('\n') if len(x.strip()) > 1]
 
         return result
 
     @property
-    def theme(self) -> dict:
+    def theme(self) -> 'Theme':
         """
-        :return: A single theme, possibly None. A theme is a dict with keys 'id', 'name', 'codename', 'active'
-        and 'subthemes', a list of subtheme ids loosely followed by Radio-Canada.
+        :return: A single theme, possibly None. A theme has the fields 'id', 'name', 'codename', 'active' and
+        'subthemes', a tuple of subtheme ids loosely followed by Radio-Canada, read as theme.name or theme['name'].
         """
-        return _theme_dict[int(self._d['ThemeId'])]
+        return resources().themes[int(self['ThemeId'])]
 
     @property
-    def subthemes(self) -> list:
+    def subthemes(self) -> tuple:
         """
-        :return: A possibly empty list of subthemes. A subtheme is a dict with keys 'id', 'name', 'codename', 'active'
-        and 'theme', a possibly empty list of parent theme ids.
+        :return: A possibly empty tuple of subthemes. A subtheme has the fields 'id', 'name', 'codename', 'active',
+        'comment' and 'theme', the parent theme id or None, read as subtheme.name or subtheme['name'].
         """
-        return [_subtheme_dict[int(x)] for x in self._d['SubThemeIds']]
+        if self._subthemes is None:
+            subthemes = resources().subthemes
+            self._subthemes = tuple(subthemes[int(x)] for x in self['SubThemeIds'])
+        return self._subthemes
 
-    def write_to(self, output_file):
+    def write_to(self, output_file, codec=None, dictionary=None):
         """
         Writes the json to output_file
         :param output_file: Output file.
+        :param codec: 'gzip' or 'zstd' to compress the json. By default, output files whose name ends with .gz or
+        .zst are compressed.
+        :param dictionary: A zstd dictionary, see donnees.compression.
         :return: void
         """
-        with open(output_file, 'wb') as fout:
-            fout.write(orjson.dumps(self._d))
+        if self._raw is not None:
+            self._decode_all()
+        codec = codec or compression.codec_of(output_file)
+        data = compression.compress(orjson.dumps(self._d), codec, dictionary)
+        run_stage('write', _write_file, output_file, data)
+        if _instrumentation is not None:
+            _instrumentation.bytes_written += len(data)
+
+
+# elements removed before getting the text of a body: tag -> classes (None to remove the tag whatever its class)
+_LEDEVOIR_REMOVED = {'script': None, 'noscript': None, 'style': None}
+_RADIOCAN_REMOVED = {'script': None, 'noscript': None, 'style': None, 'span': {'creator', 'copyrightHolder'}}
+
+
+def _lxml_text(html: str, removed: dict) -> str:
+    """
+    Fast equivalent of BeautifulSoup(html, "lxml").get_text() after decomposing the elements in removed.
+    Like BeautifulSoup, the text is collected from the events of the lxml parser rather than from its tree, so that
+    the text after a stray </html>, which lxml leaves out of the tree, is kept. Comments, processing instructions,
+    doctypes and the content of <template> elements are ignored and whitespace-only strings outside <pre> and
+    <textarea> are collapsed to a single newline or space.
+    """
+    _lxml_text_target.reset(removed)
+    return lxml.etree.fromstring(html, _lxml_text_parser)
+
+
+_PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+_ASCII_SPACES = str.maketrans('', '', '\x20\x0a\x09\x0c\x0d')
+
+
+def _bs4_string(text, preserve):
+    if not preserve and not text.translate(_ASCII_SPACES):
+        return '\n' if '\n' in text else ' '
+    return text
+
+
+class _TextTarget:
+    """
+    lxml parser target of _lxml_text. Like BeautifulSoup, the data between two tags or comments forms one string.
+    """
+
+    def __init__(self):
+        self.reset({})
+
+    def reset(self, removed: dict):
+        self.removed = removed
+        self.parts = []
+        self.pending = []
+        self.skipped = 0  # depth inside a removed element
+        self.preserved = 0  # depth inside <pre> and <textarea>
+
+    def _end_string(self):
+        if self.pending:
+            self.parts.append(_bs4_string(''.join(self.pending), self.preserved > 0))
+            self.pending = []
+
+    def start(self, tag, attrib):
+        self._end_string()
+        if self.skipped:
+            self.skipped += 1
+            return
+        classes = self.removed.get(tag, False)
+        if tag == 'template' or classes is None or (
+                classes is not False and classes.intersection(attrib.get('class', '').split())):
+            self.skipped = 1
+        elif tag in _PRESERVE_WHITESPACE_TAGS:
+            self.preserved += 1
+
+    def end(self, tag):
+        self._end_string()
+        if self.skipped:
+            self.skipped -= 1
+        elif tag in _PRESERVE_WHITESPACE_TAGS:
+            self.preserved -= 1
+
+    def data(self, text):
+        if not self.skipped:
+            self.pending.append(text)
+
+    def comment(self, text):
+        self._end_string()
+
+    def pi(self, target, data=None):
+        self._end_string()
+
+    def doctype(self, name, public_id, system_url):
+        self._end_string()
+
+    def close(self):
+        self._end_string()
+        return ''.join(self.parts)
+
+
+_lxml_text_target = _TextTarget()
+_lxml_text_parser = lxml.etree.HTMLParser(target=_lxml_text_target)
+
+
+def _write_file(output_file, data: bytes):
+    with open(output_file, 'wb') as fout:
+        fout.write(data)
+
+
+def run_stage(stage, fn, *args):
+    """
+    :return: fn(*args), timed as stage when the instrumentation is enabled.
+    """
+    if _instrumentation is None:
+        return fn(*args)
+    return _instrumentation.time_call(stage, fn, *args)
+
+
+def count_document(nb_bytes_read: int = 0):
+    """
+    Counts a document processed without RCollectionIt, e.g. read with source.read(), in the instrumentation.
+    :param nb_bytes_read: Size of its raw record.
+    """
+    if _instrumentation is not None:
+        _instrumentation.bytes_read += nb_bytes_read
+        _instrumentation.doc_done()
+
+
+def set_instrumentation(instrumentation):
+    """
+    Sets the instrumentation of the pipeline.
+    :param instrumentation: A donnees.instrument.Instrumentation, or None to disable it.
+    """
+    global _instrumentation
+    _instrumentation = instrumentation
+
+
+def set_paragraph_cache(cache):
+    """
+    Sets the persistent cache used by RDocument.extract_body_paragraphs.
+    :param cache: e.g. SQLiteLRUCache('paragraphs.sqlite', max_bytes=2 ** 30), or None to disable caching.
+    """
+    global _paragraph_cache
+    _paragraph_cache = cache
+
+
+class ResourcesNotFoundError(FileNotFoundError):
+    pass
+
+
+class _Record:
+    """
+    Mixin of the theme records, which are also read like the dicts they replace: record['name'], 'name' in record,
+    record.get('name'), record.keys(). Only the field names are keys.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._fields else default
+
+    def keys(self):
+        return self._fields
+
+
+class Theme(_Record, collections.namedtuple('Theme', ['id', 'name', 'codename', 'active', 'subthemes'])):
+    __slots__ = ()
+
+    def __reduce__(self):
+        # unpickled as the instance of the registry of the receiving process
+        return get_theme, (self.id,)
+
+
+class SubTheme(_Record,
+               collections.namedtuple('SubTheme', ['id', 'name', 'codename', 'active', 'comment', 'theme'])):
+    __slots__ = ()
+
+    def __reduce__(self):
+        return get_subtheme, (self.id,)
+
+
+# the read-only theme registry: themes and subthemes map an id to the single Theme or SubTheme record of this id
+Resources = collections.namedtuple('Resources', ['themes', 'subthemes'])
 
 
 def get_theme(theme_id):
-    return _theme_dict[int(theme_id)]
+    return resources().themes[int(theme_id)]
 
 
 def get_subtheme(stheme_id):
-    return _subtheme_dict[int(stheme_id)]
+    return resources().subthemes[int(stheme_id)]
+
 
+def get_theme_ids() -> list:
+    """
+    :return: The sorted ids of all the themes.
+    """
+    return sorted(resources().themes)
+
+
+def get_subtheme_ids() -> list:
+    """
+    :return: The sorted ids of all the subthemes.
+    """
+    return sorted(resources().subthemes)
 
-def load_resources():
+
+def resources() -> Resources:
+    """
+    :return: The theme registry, loaded from the snapshot if it is up to date, from the resource files otherwise.
+    Raises ResourcesNotFoundError when the resource files are not installed.
+    """
+    global _resources
+    if _resources is None:
+        theme_dict, subtheme_dict = _load_snapshot() or parse_resources()
+        themes = {k: Theme(v['id'], v['name'], v['codename'], v['active'], tuple(v['subthemes']))
+                  for k, v in theme_dict.items()}
+        subthemes = {k: SubTheme(v['id'], v['name'], v['codename'], v['active'], v['comment'], v['theme'])
+                     for k, v in subtheme_dict.items()}
+        _resources = Resources(types.MappingProxyType(themes), types.MappingProxyType(subthemes))
+    return _resources
+
+
+def _resource_signature():
+    signature = []
+    for name in _RESOURCE_FILES:
+        st = os.stat(os.path.join(_res_path, name))
+        signature.append((name, st.st_mtime_ns, st.st_size))
+    return signature
+
+
+def _load_snapshot():
+    try:
+        with open(RESOURCE_SNAPSHOT, 'rb') as fin:
+            signature, dicts = pickle.load(fin)
+        if signature == _resource_signature():
+            return dicts
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+    return None
+
+
+def compile_resources():
+    """
+    Parses the resource files once and saves them to a single binary snapshot, RESOURCE_SNAPSHOT, read instead of
+    them as long as they are not modified.
+    """
+    data = pickle.dumps((_resource_signature(), parse_resources()), protocol=pickle.HIGHEST_PROTOCOL)
+    with open(RESOURCE_SNAPSHOT + '.tmp', 'wb') as fout:
+        fout.write(data)
+    os.replace(RESOURCE_SNAPSHOT + '.tmp', RESOURCE_SNAPSHOT)
+
+
+def parse_resources() -> tuple:
+    """
+    :return: (theme dict, subtheme dict) parsed from the resource files.
+    """
     theme_file_name = os.path.join(_res_path, 'themes.tsv')
     if not os.path.exists(theme_file_name):
-        print(f"Install the resource files in the dir {_res_path} before using this API.\n"
-              f"See {os.path.join(_res_path, 'README.md')} for details.", file=sys.stderr)
-        sys.exit(1)
+        raise ResourcesNotFoundError(f"Install the resource files in the dir {_res_path} before using this API. "
+                                     f"See {os.path.join(_res_path, 'README.md')} for details.")
 
+    theme_dict = {}
     with open(theme_file_name, encoding='utf-8') as fin:
         for line in fin:
             parts = line.strip().split('\t')
-            _theme_dict[int(parts[0])] = {'id': int(parts[0]), 'name': parts[1],
-                                          'codename': parts[2], 'active': parts[3] == '1', 'subthemes': []}
+            theme_dict[int(parts[0])] = {'id': int(parts[0]), 'name': parts[1],
+                                         'codename': parts[2], 'active': parts[3] == '1', 'subthemes': []}
 
+    subtheme_dict = {}
     with open(os.path.join(_res_path, 'subthemes.tsv'), encoding='utf-8') as fin:
         for line in fin:
             clean_line = line.strip()
             if clean_line:
                 parts = clean_line.split('\t')
-                _subtheme_dict[int(parts[0])] = {'id': int(parts[0]), 'name': parts[1], 'codename': parts[2],
-                                                 'active': parts[3] == '1',
-                                                 'comment': parts[4] if len(parts) >= 5 else '', 'theme': []}
+                subtheme_dict[int(parts[0])] = {'id': int(parts[0]), 'name': parts[1], 'codename': parts[2],
+                                                'active': parts[3] == '1',
+                                                'comment': parts[4] if len(parts) >= 5 else '', 'theme': []}
 
-    rels = orjson.loads(open(os.path.join(_res_path, 'theme_soustheme_relationship.json'), 'r', encoding='utf-8').read())
+    with open(os.path.join(_res_path, 'theme_soustheme_relationship.json'), 'rb') as fin:
+        rels = orjson.loads(fin.read())
     for theme in rels:
         theme_id = int(theme['ThemeId'])
         subthemes = [int(x) for x in theme['SubThemeIds']]
-        _theme_dict[theme_id]['subthemes'] = subthemes
+        theme_dict[theme_id]['subthemes'] = subthemes
 
         for sub in subthemes:
-            assert len(_subtheme_dict[sub]['theme']) == 0, 'A single parent please.'
-            _subtheme_dict[sub]['theme'] = theme_id
-
+            assert len(subtheme_dict[sub]['theme']) == 0, 'A single parent please.'
+            subtheme_dict[sub]['theme'] = theme_id
 
-load_resources()
+    return theme_dict, subtheme_dict
@@ -0,0 +1,254 @@
+"""
+Packed collection format.
+
+A packed collection is a directory holding a few large shard files and a side index. Each shard is a sequence of
+records, one record per original JSON file, optionally zstd-compressed one by one. The index maps every document
+to its (shard, offset, length) so the collection can be read sequentially in bulk or randomly by document id.
+
+(c) RALI, Université de Montréal.
+"""
+import collections
+import hashlib
+import mmap
+import os
+import random
+import sys
+
+import orjson
+
+from donnees import compression
+from donnees.prefetch import is_network_path
+
+PACK_MANIFEST = 'rcan-pack.json'
+PACK_INDEX = 'rcan-pack.idx'
+PACK_VERSION = 1
+
+
+def is_packed(col_spec: str) -> bool:
+    """
+    :param col_spec: A collection path.
+    :return: True if col_spec is a packed collection directory.
+    """
+    return os.path.isfile(os.path.join(col_spec, PACK_MANIFEST))
+
+
+PackEntry = collections.namedtuple('PackEntry', ['name', 'doc_id', 'shard', 'offset', 'length'])
+"""An index entry. name is the original file name of the document, doc_id its _id as a string."""
+
+
+class PackedSource:
+    """
+    Reads raw records from a packed collection. Shards on a local filesystem are memory-mapped, shards on a
+    network filesystem are read with buffered sequential reads.
+    """
+    def __init__(self, col_spec: str, use_mmap: bool = None):
+        """
+        :param use_mmap: Memory-map the shards, by default when they are not on a network filesystem.
+        """
+        self.col_spec = col_spec
+        with open(os.path.join(col_spec, PACK_MANIFEST), 'rb') as fin:
+            self.manifest = orjson.loads(fin.read())
+
+        if self.manifest.get('version') != PACK_VERSION:
+            raise ValueError(f"Unsupported pack version {self.manifest.get('version')} in {col_spec}")
+
+        self.shards = self.manifest['shards']
+        self.compression = self.manifest.get('compression')
+        self.dictionary = None
+        if self.compression:
+            compression.check_zstd()
+            if self.manifest.get('dictionary'):
+                self.dictionary = compression.load_dictionary(os.path.join(col_spec, self.manifest['dictionary']))
+        self._entries = None
+        self._by_id = None
+        self.use_mmap = not is_network_path(col_spec) if use_mmap is None else use_mmap
+        self._maps = {}
+        self._shard_signatures = None
+
+    def entries(self) -> list:
+        """
+        :return: The list of PackEntry of the pack, in physical order.
+        """
+        if self._entries is None:
+            entries = []
+            with open(os.path.join(self.col_spec, PACK_INDEX), 'r', encoding='utf-8') as fin:
+                for line in fin:
+                    name, doc_id, shard, offset, length = line.rstrip('\n').split('\t')
+                    entries.append(PackEntry(name, doc_id, int(shard), int(offset), int(length)))
+            self._entries = entries
+        return self._entries
+
+    def locate(self, doc_id) -> PackEntry:
+        """
+        :return: The index entry of document doc_id. Raises KeyError if it is not in the pack.
+        """
+        if self._by_id is None:
+            self._by_id = {x.doc_id: x for x in self.entries()}
+        return self._by_id[str(doc_id)]
+
+    def sort_entries(self, entries: list) -> list:
+        """Sorts entries by physical location."""
+        return sorted(entries, key=lambda x: (x.shard, x.offset))
+
+    def signature(self, entry: PackEntry):
+        """
+        Entries move when a collection is packed again, so the signature of a packed document is the hash of its
+        content, see content_signature.
+        :return: None.
+        """
+        return None
+
+    def location_signature(self, entry: PackEntry) -> str:
+        """
+        Packs are only ever written whole, so a record is identified by its location and the modification time and
+        size of its shard, without reading it.
+        :return: A string that changes when the pack holding entry is rewritten.
+        """
+        if self._shard_signatures is None:
+            stats = [os.stat(os.path.join(self.col_spec, x)) for x in self.shards]
+            self._shard_signatures = [f"{x.st_mtime_ns}-{x.st_size}" for x in stats]
+        return f"{self._shard_signatures[entry.shard]}:{entry.offset}:{entry.length}"
+
+    def source_file(self, entry: PackEntry) -> str:
+        """Virtual path of the document, as if the collection was not packed."""
+        return os.path.join(self.col_spec, entry.name)
+
+    def _decompressor(self):
+        return compression.zstd_decompressor(self.dictionary) if self.compression else None
+
+    def _decode(self, data, decompressor):
+        return decompressor.decompress(data) if decompressor else data
+
+    def _safe_decode(self, data, decompressor):
+        try:
+            return self._decode(data, decompressor)
+        except compression.READ_ERRORS:
+            return None
+
+    def _map(self, shard: int):
+        result = self._maps.get(shard)
+        if result is None:
+            with open(os.path.join(self.col_spec, self.shards[shard]), 'rb') as fin:
+                # an empty file cannot be mapped
+                result = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fin.fileno()).st_size else b''
+            self._maps[shard] = result
+        return result
+
+    def read(self, entry: PackEntry) -> bytes:
+        """
+        :return: The raw JSON bytes of a single entry.
+        """
+        if self.use_mmap:
+            return self._decode(self._map(entry.shard)[entry.offset:entry.offset + entry.length], self._decompressor())
+        with open(os.path.join(self.col_spec, self.shards[entry.shard]), 'rb') as fin:
+            fin.seek(entry.offset)
+            return self._decode(fin.read(entry.length), self._decompressor())
+
+    def iter_raw(self, entries=None):
+        """
+        Reads entries in physical order, one shard after the other.
+        :param entries: The entries to read, all of them if None. Must be sorted by (shard, offset).
+        :return: An iterator over (entry, raw bytes). raw bytes is None when the record could not be decompressed.
+        """
+        decompressor = self._decompressor()
+        if self.use_mmap:
+            for entry in (self.entries() if entries is None else entries):
+                yield entry, self._safe_decode(self._map(entry.shard)[entry.offset:entry.offset + entry.length],
+                                               decompressor)
+            return
+
+        cur_shard = None
+        fin = None
+        try:
+            for entry in (self.entries() if entries is None else entries):
+                if entry.shard != cur_shard:
+                    if fin:
+                        fin.close()
+                    cur_shard = entry.shard
+                    fin = open(os.path.join(self.col_spec, self.shards[cur_shard]), 'rb', buffering=1 << 20)
+                if fin.tell() != entry.offset:
+                    fin.seek(entry.offset)
+                yield entry, self._safe_decode(fin.read(entry.length), decompressor)
+        finally:
+            if fin:
+                fin.close()
+
+
+def pack_collection(in_dir: str, out_dir: str, shard_size: int = 1 << 30, compress: bool = False, level: int = 3,
+                    dictionary: bool = False):
+    """
+    Rolls a directory of JSON files (possibly compressed, see donnees.compression) into a packed collection.
+
+    :param in_dir: A directory containing the JSON files of the collection.
+    :param out_dir: Output directory, created if needed.
+    :param shard_size: Approximate maximum size of a shard, in bytes.
+    :param compress: Compress every record with zstd.
+    :param level: zstd compression level.
+    :param dictionary: Compress with a zstd dictionary trained on a sample of the collection.
+    :return: The number of documents packed.
+    """
+    if compress:
+        compression.check_zstd()
+    in_dictionary = compression.load_dictionary(os.path.join(in_dir, compression.ZSTD_DICT_FILE))
+
+    def read(name):
+        with open(os.path.join(in_dir, name), 'rb') as fin:
+            return compression.decompress(fin.read(), compression.codec_of(name), in_dictionary)
+
+    os.makedirs(out_dir, exist_ok=True)
+    names = sorted(x.name for x in os.scandir(in_dir) if x.is_file() and x.name.endswith(compression.DOC_SUFFIXES))
+
+    dict_data = None
+    if compress and dictionary and names:
+        sample = random.Random(0).sample(names, min(2000, len(names)))
+        dict_data = compression.train_dictionary([read(x) for x in sample])
+        compression.save_dictionary(dict_data, os.path.join(out_dir, compression.ZSTD_DICT_FILE))
+    compressor = compression.zstd_compressor(dict_data, level) if compress else None
+
+    shards = []
+    nb_docs = 0
+    fout = None
+    shard_pos = 0
+
+    with open(os.path.join(out_dir, PACK_INDEX + '.tmp'), 'w', encoding='utf-8') as idx_out:
+        for name in names:
+            try:
+                data = read(name)
+                doc_id = str(orjson.loads(data)['_id'])
+            except Exception:
+                print(f"Problem reading file {os.path.join(in_dir, name)}, skipped.", file=sys.stderr)
+                continue
+
+            if compressor:
+                data = compressor.compress(data)
+
+            if fout is None or (shard_pos and shard_pos + len(data) > shard_size):
+                if fout:
+                    fout.close()
+                shards.append(f"shard-{len(shards):05d}.bin")
+                fout = open(os.path.join(out_dir, shards[-1]), 'wb', buffering=1 << 20)
+                shard_pos = 0
+
+            fout.write(data)
+            idx_out.write(f"{name}\t{doc_id}\t{len(shards) - 1}\t{shard_pos}\t{len(data)}\n")
+            shard_pos += len(data)
+            nb_docs += 1
+
+    if fout:
+        fout.close()
+
+    os.replace(os.path.join(out_dir, PACK_INDEX + '.tmp'), os.path.join(out_dir, PACK_INDEX))
+    manifest = {'version': PACK_VERSION, 'shards': shards, 'compression': 'zstd' if compress else None,
+                'dictionary': compression.ZSTD_DICT_FILE if dict_data is not None else None, 'nb_docs': nb_docs}
+    # the manifest is written last, a pack interrupted midway is not detected as such
+    with open(os.path.join(out_dir, PACK_MANIFEST), 'wb') as fout:
+        fout.write(orjson.dumps(manifest))
+
+    return nb_docs
+
+
+def content_signature(data: bytes) -> str:
+    """
+    :return: A hash of the raw content of a document.
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
@@ -0,0 +1,150 @@
+"""
+Columnar store of the theme references.
+
+The reference maps a doc id to a list [theme id, subtheme id, ...]. It is stored as three NumPy arrays written
+next to each other, which are memory-mapped when loaded:
+
+- <prefix>.ids.npy: the sorted doc ids (int64);
+- <prefix>.offsets.npy: CSR offsets (int64), the labels of the i-th doc are labels[offsets[i]:offsets[i + 1]];
+- <prefix>.labels.npy: the theme then the subthemes of every doc (int32).
+
+(c) RALI, Université de Montréal.
+"""
+import array
+import bz2
+import os
+import pickle
+
+import numpy
+
+DEFAULT_PREFIX = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'resources', 'ref-rcan-themes')
+_SUFFIXES = ('ids', 'offsets', 'labels')
+
+
+class ReferenceStore:
+    """
+    A read-only mapping doc id -> [theme id, subtheme id, ...], compatible with the dict of lists it replaces
+    for int doc ids.
+    """
+    def __init__(self, ids, offsets, labels):
+        self.ids = ids
+        self.offsets = offsets
+        self.labels = labels
+
+    def rows(self, doc_ids) -> numpy.ndarray:
+        """
+        :param doc_ids: An array of doc ids.
+        :return: The row of every doc id in the store, -1 for the doc ids it does not contain.
+        """
+        doc_ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+        if not len(self.ids):
+            return numpy.full(len(doc_ids), -1)
+        rows = numpy.searchsorted(self.ids, doc_ids)
+        rows[rows == len(self.ids)] = 0
+        return numpy.where(self.ids[rows] == doc_ids, rows, -1)
+
+    def _row(self, doc_id):
+        if not isinstance(doc_id, (int, numpy.integer)) or isinstance(doc_id, bool):
+            return -1
+        row = int(numpy.searchsorted(self.ids, doc_id))
+        return row if row < len(self.ids) and self.ids[row] == doc_id else -1
+
+    def __contains__(self, doc_id):
+        return self._row(doc_id) >= 0
+
+    def __getitem__(self, doc_id) -> list:
+        row = self._row(doc_id)
+        if row < 0:
+            raise KeyError(doc_id)
+        return self.labels[self.offsets[row]:self.offsets[row + 1]].tolist()
+
+    def get(self, doc_id, default=None):
+        return self[doc_id] if doc_id in self else default
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def keys(self):
+        return self.ids.tolist()
+
+    def items(self):
+        for row, doc_id in enumerate(self.ids.tolist()):
+            yield doc_id, self.labels[self.offsets[row]:self.offsets[row + 1]].tolist()
+
+
+def write_reference(reference, prefix: str):
+    """
+    :param reference: A dict doc id -> [theme id, subtheme id, ...], or an iterable of such pairs.
+    :param prefix: Path prefix of the three array files.
+    """
+    items = sorted(reference.items() if isinstance(reference, dict) else reference)
+    ids = numpy.fromiter((int(x[0]) for x in items), dtype=numpy.int64, count=len(items))
+    lengths = numpy.fromiter((len(x[1]) for x in items), dtype=numpy.int64, count=len(items))
+    offsets = numpy.zeros(len(items) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+    labels = numpy.fromiter((int(y) for x in items for y in x[1]), dtype=numpy.int32, count=int(offsets[-1]))
+    write_arrays(ids, offsets, labels, prefix)
+
+
+class ReferenceBuilder:
+    """
+    Accumulates a reference in compact arrays, in any doc id order, about 12 bytes per doc plus 4 per label.
+    """
+    def __init__(self):
+        self.ids = array.array('q')
+        self.lengths = array.array('q')
+        self.labels = array.array('i')
+
+    def add(self, doc_id, labels: list):
+        self.ids.append(int(doc_id))
+        self.lengths.append(len(labels))
+        self.labels.extend(labels)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def write(self, prefix: str):
+        ids = numpy.frombuffer(self.ids, dtype=numpy.int64)
+        lengths = numpy.frombuffer(self.lengths, dtype=numpy.int64)
+        labels = numpy.frombuffer(self.labels, dtype=numpy.int32)
+
+        order = numpy.argsort(ids, kind='stable')
+        if len(ids) > 1 and (ids[order][1:] == ids[order][:-1]).any():
+            raise ValueError("Duplicate doc ids in the reference")
+        starts = numpy.cumsum(lengths) - lengths
+        offsets = numpy.zeros(len(ids) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths[order], out=offsets[1:])
+        # position in labels of every label of the sorted rows
+        positions = numpy.repeat(starts[order] - offsets[:-1], lengths[order]) + numpy.arange(offsets[-1])
+        write_arrays(ids[order], offsets, labels[positions], prefix)
+
+
+def write_arrays(ids, offsets, labels, prefix: str):
+    """Writes already built arrays; ids must be sorted and unique."""
+    for suffix, array in zip(_SUFFIXES, (ids, offsets, labels)):
+        numpy.save(f"{prefix}.{suffix}.npy", array)
+
+
+def load_reference(prefix: str, mmap: bool = True) -> ReferenceStore:
+    """
+    :param prefix: Path prefix of the three array files.
+    :param mmap: Memory-map the arrays instead of reading them.
+    """
+    arrays = [numpy.load(f"{prefix}.{x}.npy", mmap_mode='r' if mmap else None) for x in _SUFFIXES]
+    return ReferenceStore(*arrays)
+
+
+def exists(prefix: str) -> bool:
+    return all(os.path.exists(f"{prefix}.{x}.npy") for x in _SUFFIXES)
+
+
+def load_theme_reference(prefix: str = DEFAULT_PREFIX):
+    """
+    Loads the theme reference: the columnar store if it exists, otherwise the legacy <prefix>.pkl.bz2 dict.
+    """
+    if exists(prefix):
+        return load_reference(prefix)
+    return pickle.load(bz2.open(prefix + '.pkl.bz2', 'rb'))
@@ -0,0 +1,253 @@
+"""
+Concurrent client for the DBpedia Spotlight annotation service.
+
+(c) RALI, Université de Montréal.
+"""
+import collections.abc
+import concurrent.futures
+import random
+import threading
+import time
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+
+from donnees.cache import content_key
+
+DEFAULT_URL = "http://octal15.iro.umontreal.ca:8081/rest/candidates"
+
+
+class RateLimiter:
+    """
+    Spaces calls to wait() so that at most rate calls per second go through, across threads.
+    """
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SpotlightAnnotator:
+    """
+    Posts texts to Spotlight from a pool of threads, each with its own pooled HTTP session. Timeouts, connection
+    errors, 429 and 5xx responses are retried with exponential backoff; other errors are returned to the caller.
+
+    With a cache, annotations are stored under a hash of the normalized text and of the request parameters, so
+    that duplicate texts (dispatches, republished articles) are posted once. At the paragraph level, every
+    paragraph is annotated and cached on its own and the annotations are merged, which also reuses the paragraphs
+    shared by updated articles, at the cost of a context limited to the paragraph.
+    """
+    def __init__(self, url: str = DEFAULT_URL, concurrency: int = 8, confidence: float = 0.4, support: int = -1,
+                 max_retries: int = 5, backoff: float = 0.5, timeout: float = 120, rate_limit: float = None,
+                 cache=None, paragraph_level: bool = False):
+        """
+        :param url: The Spotlight endpoint.
+        :param concurrency: Maximum number of requests in flight.
+        :param max_retries: Number of retries of a failed request before giving up.
+        :param backoff: Delay before the first retry, in seconds, doubled at every retry.
+        :param timeout: Timeout of a single request, in seconds.
+        :param rate_limit: Maximum number of requests per second, unlimited if None.
+        :param cache: A response cache (e.g. donnees.cache.SQLiteLRUCache), None to always post.
+        :param paragraph_level: With a cache, annotate and cache paragraph by paragraph.
+        """
+        self.url = url
+        self.concurrency = concurrency
+        self.params = {'confidence': confidence, 'support': support}
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self._local = threading.local()
+        self.cache = cache
+        self.paragraph_level = paragraph_level
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self.nb_requests = 0
+        self.nb_retries = 0
+        self.nb_shared = 0
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        return session
+
+    def annotate(self, text: str) -> bytes:
+        """
+        Annotates a single text, blocking. Thread-safe. When caching, the text is normalized (see normalize_text)
+        before being posted.
+        :return: The raw JSON response. Raises requests.RequestException when the request keeps failing.
+        """
+        if self.cache is None:
+            return self._post(text)
+
+        text = normalize_text(text)
+        if not self.paragraph_level:
+            return orjson.dumps(self._cached_annotation(text))
+
+        paras = text.split('\n')
+        return orjson.dumps(merge_annotations(paras, [self._cached_annotation(x) for x in paras]))
+
+    def _cached_annotation(self, text: str):
+        key = content_key('spotlight', text, self.params['confidence'], self.params['support'])
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        # the same text may be requested by several threads at once: only the first one posts it
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = concurrent.futures.Future()
+
+        if not owner:
+            self.nb_shared += 1
+            return future.result()
+
+        try:
+            result = orjson.loads(self._post(text))
+            self.cache.put(key, result)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+
+    def stats(self) -> dict:
+        """
+        :return: Request counters, and cache hit counters if there is a cache.
+        """
+        result = {'requests': self.nb_requests, 'retries': self.nb_retries, 'shared_in_flight': self.nb_shared}
+        if self.cache is not None:
+            result.update(self.cache.stats())
+        return result
+
+    def _post(self, text: str) -> bytes:
+        session = self._session()
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.wait()
+
+            self.nb_requests += 1
+            try:
+                response = session.post(self.url, dict(self.params, text=text),
+                                        headers={'Accept': 'application/json'}, timeout=self.timeout)
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    return response.content
+                error = requests.HTTPError(f"{response.status_code} error from {self.url}", response=response)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                error = e
+
+            if attempt == self.max_retries:
+                raise error
+            self.nb_retries += 1
+            time.sleep(self.backoff * 2 ** attempt * (1 + random.random() / 2))
+
+    def annotate_all(self, items):
+        """
+        Annotates texts concurrently, with at most 2 * concurrency texts read ahead from items.
+        :param items: An iterable of (key, text).
+        :return: An iterator over (key, response content or exception), in completion order.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = {}
+            for key, text in items:
+                if len(pending) >= 2 * self.concurrency:
+                    yield from self._pop_done(pending)
+                pending[executor.submit(self.annotate, text)] = key
+
+            while pending:
+                yield from self._pop_done(pending)
+
+    @staticmethod
+    def _pop_done(pending):
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            key = pending.pop(future)
+            error = future.exception()
+            yield key, (error if error is not None else future.result())
+
+
+class DoneSet(collections.abc.Set):
+    """
+    A persistent set of strings, appended to a file as they are added, so that a run can be resumed.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._items = set()
+        try:
+            with open(path, 'r', encoding='utf-8') as fin:
+                self._items.update(x.rstrip('\n') for x in fin if x.endswith('\n'))
+        except FileNotFoundError:
+            pass
+        self._fout = open(path, 'a', encoding='utf-8')
+
+    def add(self, item: str):
+        if item not in self._items:
+            self._items.add(item)
+            self._fout.write(item + '\n')
+            self._fout.flush()
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def close(self):
+        self._fout.close()
+
+
+def normalize_text(text: str) -> str:
+    """
+    :return: text with the whitespace of every line collapsed and the empty lines removed.
+    """
+    lines = (' '.join(x.split()) for x in text.split('\n'))
+    return '\n'.join(x for x in lines if x)
+
+
+def merge_annotations(paras: list, annotations: list) -> dict:
+    """
+    Merges the annotations of paragraphs into the annotation of '\n'.join(paras), shifting the offsets of the
+    surface forms.
+    """
+    result = None
+    surface_forms = []
+    start = 0
+    for para, annotation in zip(paras, annotations):
+        content = annotation.get('annotation') if isinstance(annotation, dict) else None
+        if content is not None:
+            if result is None:
+                result = {'annotation': dict(content)}
+            forms = content.get('surfaceForm', [])
+            for form in (forms if isinstance(forms, list) else [forms]):
+                form = dict(form)
+                form['@offset'] = str(int(form['@offset']) + start)
+                surface_forms.append(form)
+        start += len(para) + 1
+
+    if result is None:
+        return {'annotation': {'@text': '\n'.join(paras), 'surfaceForm': []}}
+
+    result['annotation']['@text'] = '\n'.join(paras)
+    result['annotation']['surfaceForm'] = surface_forms
+    return result
@@ -0,0 +1,132 @@
+"""
+Synthetic collections and prediction files, for benchmarks and for trying the tools without the real data.
+
+Documents look like the Radio-Canada and Le Devoir articles of the collection: Lead and Body are HTML with the
+elements the extraction handles (figures with credits, scripts, styles, section headers, related content), and
+themes and subthemes are drawn from the resource tables.
+
+(c) RALI, Université de Montréal.
+"""
+import os
+import random
+
+import orjson
+
+from donnees.rcan_coll import resources
+
+_WORDS = ("le la les un une des de du et à en pour sur avec dans par au aux ce cette qui que est sont a ont "
+          "gouvernement ministre Québec Montréal Ottawa Canada économie santé élection budget école hôpital "
+          "entreprise marché emploi culture festival film musique hockey match saison équipe joueur pluie neige "
+          "tempête police enquête tribunal projet ville quartier citoyens rapport étude hausse baisse millions "
+          "dollars selon a-t-il déclaré mardi mercredi jeudi vendredi semaine année printemps été automne hiver").split()
+
+
+def _sentence(rnd, min_words=6, max_words=30):
+    text = ' '.join(rnd.choices(_WORDS, k=rnd.randint(min_words, max_words)))
+    return text[0].upper() + text[1:] + ('.' if rnd.random() < 0.9 else rnd.choice('!?'))
+
+
+def _paragraph(rnd):
+    return ' '.join(_sentence(rnd) for _ in range(rnd.randint(1, 4)))
+
+
+def radio_canada_body(rnd) -> str:
+    parts = []
+    for i in range(rnd.randint(3, 15)):
+        if i and rnd.random() < 0.15:
+            parts.append(f"<h2>{_sentence(rnd, 2, 6)}</h2>")
+        if rnd.random() < 0.15:
+            parts.append('<figure><img src="https://images.radio-canada.ca/x.jpg" alt=""/>'
+                         f'<figcaption>{_sentence(rnd, 4, 12)} <span class="creator">Photo : Radio-Canada</span> '
+                         '<span class="copyrightHolder">La Presse canadienne</span></figcaption></figure>')
+        if rnd.random() < 0.05:
+            parts.append('<script type="text/javascript">window.dataLayer = window.dataLayer || [];</script>')
+        parts.append(f"<p>{_paragraph(rnd)}</p>")
+    if rnd.random() < 0.3:
+        parts.append(f'<div class="related"><h3>À lire aussi</h3><ul><li><a href="#">{_sentence(rnd, 4, 10)}</a>'
+                     f'</li><li><a href="#">{_sentence(rnd, 4, 10)}</a></li></ul></div>')
+    return '\n'.join(parts)
+
+
+def le_devoir_body(rnd) -> str:
+    parts = []
+    for i in range(rnd.randint(3, 20)):
+        if rnd.random() < 0.1:
+            parts.append(f"<blockquote><p>« {_sentence(rnd)} »</p></blockquote>")
+        if rnd.random() < 0.05:
+            parts.append('<noscript><img src="https://pixel.ledevoir.com/p.gif"/></noscript>'
+                         '<style>.encadre { margin: 0 }</style>')
+        if rnd.random() < 0.1:
+            parts.append(f"<p><strong>{_sentence(rnd, 2, 5)}</strong><br/>{_paragraph(rnd)}</p>")
+        else:
+            parts.append(f"<p>{_paragraph(rnd)}</p>")
+    return '\n'.join(parts)
+
+
+def make_document(rnd, doc_id: int, ledevoir_ratio: float = 0.3) -> dict:
+    """
+    :return: The JSON dict of a synthetic document.
+    """
+    registry = resources()
+    ledevoir = rnd.random() < ledevoir_ratio
+    theme = rnd.choice(list(registry.themes.values()))
+    candidates = list(theme.subthemes) or list(registry.subthemes)
+    subthemes = rnd.sample(candidates, min(len(candidates), rnd.choice((0, 1, 1, 2, 2, 3))))
+    if ledevoir:
+        url = f"https://www.ledevoir.com/societe/{doc_id}/{'-'.join(rnd.choices(_WORDS, k=5))}"
+        lead = f"<p>{_sentence(rnd)}</p>"
+        body = le_devoir_body(rnd)
+    else:
+        url = f"https://ici.radio-canada.ca/nouvelle/{doc_id}/{'-'.join(rnd.choices(_WORDS, k=5))}"
+        lead = f"<p><strong>{_sentence(rnd)}</strong></p>"
+        body = radio_canada_body(rnd)
+
+    return {'_id': doc_id, 'SearchableTitle': _sentence(rnd, 4, 12), 'SearchableSummary': _sentence(rnd, 10, 30),
+            'FirstPublishedCanonicalWebLink': url, 'Lead': lead, 'Body': body, 'ThemeId': theme.id,
+            'SubThemeIds': subthemes, 'IsDispatch': rnd.random() < 0.2,
+            'FirstPublishedDate': f"{rnd.randint(2010, 2019)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"
+                                  f"T{rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}:00Z"}
+
+
+def generate_collection(out_dir: str, nb_docs: int, seed: int = 0, first_id: int = 1000000,
+                        ledevoir_ratio: float = 0.3) -> dict:
+    """
+    Writes a directory collection of nb_docs synthetic documents, named <id>.json.
+    :return: The reference of the collection, a dict doc id -> [theme id, subtheme id, ...].
+    """
+    rnd = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    reference = {}
+    for doc_id in range(first_id, first_id + nb_docs):
+        doc = make_document(rnd, doc_id, ledevoir_ratio)
+        with open(os.path.join(out_dir, f"{doc_id}.json"), 'wb') as fout:
+            fout.write(orjson.dumps(doc))
+        reference[doc_id] = [doc['ThemeId']] + doc['SubThemeIds']
+    return reference
+
+
+def make_predictions(reference: dict, seed: int = 0, accuracy: float = 0.6, nb_preds: int = 5) -> dict:
+    """
+    :param reference: A dict doc id -> [theme id, subtheme id, ...].
+    :param accuracy: Probability that a reference label is predicted, at a random rank.
+    :return: Predictions in the format of the prediction files: str doc id -> {'theme': [[id, score], ...],
+    'sub_themes': [...]}.
+    """
+    rnd = random.Random(seed)
+    registry = resources()
+    theme_ids = sorted(registry.themes)
+    subtheme_ids = sorted(registry.subthemes)
+
+    def ranked(true_labels, label_ids):
+        labels = [x for x in true_labels if rnd.random() < accuracy]
+        while len(labels) < nb_preds:
+            label = rnd.choice(label_ids)
+            if label not in labels:
+                labels.append(label)
+        labels = labels[:nb_preds]
+        rnd.shuffle(labels)
+        scores = sorted((rnd.random() for _ in labels), reverse=True)
+        return [[x, round(y, 4)] for x, y in zip(labels, scores)]
+
+    return {str(doc_id): {'theme': ranked(labels[:1], theme_ids), 'sub_themes': ranked(labels[1:], subtheme_ids)}
+            for doc_id, labels in reference.items()}
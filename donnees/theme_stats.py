@@ -0,0 +1,152 @@
+"""
+Incremental subtheme x theme co-occurrence counts over a collection.
+
+Counts are computed per chunk of documents by parallel workers and merged. They are saved along with a manifest
+recording, for every file counted, its signature and its contribution to the matrix, so that an update only
+counts new or modified files and subtracts the contributions of modified or removed ones.
+
+(c) RALI, Université de Montréal.
+"""
+import os
+import sys
+
+import numpy
+
+from donnees import rcan_coll
+from donnees.coll_index import changed_entries, checked_signature, entry_name
+from donnees.rcan_coll import RCollection, count_document, run_chunks, run_stage
+
+STATS_VERSION = 1
+CHUNK_SIZE = 1024
+
+
+def matrix_shape() -> tuple:
+    """
+    :return: (number of subtheme rows, number of theme columns), from the loaded resources. Row 0 counts the
+    documents without subtheme, column 0 the documents without theme.
+    """
+    return max([0] + rcan_coll.get_subtheme_ids()) + 1, max([0] + rcan_coll.get_theme_ids()) + 1
+
+
+class ThemeStats:
+    """
+    A count matrix freqs[subtheme id][theme id] and the contribution of every file counted.
+    """
+    def __init__(self, shape: tuple = None):
+        self.freqs = numpy.zeros(shape or matrix_shape())
+        self.files = {}  # file name -> (signature, theme id, tuple of subtheme ids)
+
+    def add(self, name: str, signature: str, theme: int, subthemes: tuple):
+        if name in self.files:
+            self.remove(name)
+        for sth in subthemes:
+            self.freqs[sth][theme] += 1
+        self.files[name] = (signature, theme, subthemes)
+
+    def remove(self, name: str):
+        _, theme, subthemes = self.files.pop(name)
+        for sth in subthemes:
+            self.freqs[sth][theme] -= 1
+
+    def merge(self, other: 'ThemeStats') -> 'ThemeStats':
+        """Adds the counts of other, computed over other files, to self. Returns self."""
+        for name in other.files.keys() & self.files.keys():
+            self.remove(name)
+        self.freqs += other.freqs
+        self.files.update(other.files)
+        return self
+
+    def save(self, prefix: str):
+        """
+        Writes <prefix>.npy and <prefix>.manifest.
+        """
+        with open(prefix + '.npy.tmp', 'wb') as fout:
+            numpy.save(fout, self.freqs)
+        with open(prefix + '.manifest.tmp', 'w', encoding='utf-8') as fout:
+            fout.write(f"#version={STATS_VERSION}\tshape={self.freqs.shape[0]}x{self.freqs.shape[1]}\n")
+            for name, (signature, theme, subthemes) in self.files.items():
+                fout.write(f"{name}\t{signature}\t{theme}\t{','.join(str(x) for x in subthemes)}\n")
+        os.replace(prefix + '.npy.tmp', prefix + '.npy')
+        os.replace(prefix + '.manifest.tmp', prefix + '.manifest')
+
+    @staticmethod
+    def load(prefix: str):
+        """
+        :return: The saved stats, or None when they do not exist or were saved by another version or for other
+        resources.
+        """
+        if not os.path.exists(prefix + '.manifest') or not os.path.exists(prefix + '.npy'):
+            return None
+
+        shape = matrix_shape()
+        result = ThemeStats(shape)
+        with open(prefix + '.manifest', 'r', encoding='utf-8') as fin:
+            if fin.readline().rstrip('\n') != f"#version={STATS_VERSION}\tshape={shape[0]}x{shape[1]}":
+                return None
+            for line in fin:
+                name, signature, theme, subthemes = line.rstrip('\n').split('\t')
+                result.files[name] = (signature, int(theme), tuple(int(x) for x in subthemes.split(',')))
+
+        result.freqs = numpy.load(prefix + '.npy')
+        return result
+
+
+def doc_contribution(doc) -> tuple:
+    """
+    :return: (theme id, tuple of subtheme ids) counted for a document, 0 standing for no theme or no subtheme.
+    """
+    theme = doc.theme['id'] if doc.theme else 0
+    subthemes = tuple(x['id'] for x in doc.subthemes) if doc.subthemes else (0,)
+    return theme, subthemes
+
+
+def _count_chunk(args, tasks):
+    col_spec, shape = args
+    coll = RCollection(col_spec)
+    result = ThemeStats(shape)
+
+    for entry, signature, known_signature in tasks:
+        source_file = coll.source.source_file(entry)
+        data = b''
+        try:
+            data = run_stage('read', coll.source.read, entry)
+            signature = checked_signature(signature, known_signature, data)
+            if signature is None:
+                continue
+
+            doc = run_stage('decode', coll.decode, entry, data, ['ThemeId', 'SubThemeIds'])
+            theme, subthemes = doc_contribution(doc)
+            result.add(os.path.basename(source_file), signature, theme, subthemes)
+        except:
+            print(f"Problem with {source_file}: {sys.exc_info()[0]}", file=sys.stderr)
+        count_document(len(data))
+
+    return result
+
+
+def update_stats(coll: RCollection, stats: ThemeStats = None, workers: int = None) -> ThemeStats:
+    """
+    Brings stats up to date with the collection.
+    :param stats: Stats computed previously, None to count everything.
+    :param workers: Number of processes.
+    :return: The updated stats (stats itself when given).
+    """
+    shape = matrix_shape()
+    stats = ThemeStats(shape) if stats is None else stats
+    entries = coll.source.entries()
+    signatures = [coll.source.signature(x) for x in entries]
+    known = {name: x[0] for name, x in stats.files.items()}
+    _, chunks = changed_entries(entries, signatures, {k: (v, None) for k, v in known.items()}, CHUNK_SIZE)
+
+    def tasks():
+        for positions in chunks:
+            yield [(entries[i], signatures[i], known.get(entry_name(entries[i]))) for i in positions]
+
+    for partial in run_chunks(_count_chunk, (coll.col_spec, shape), tasks(), workers, ordered=False):
+        stats.merge(partial)
+
+    seen = {entry_name(x) for x in entries}
+    for name in [x for x in stats.files if x not in seen]:
+        stats.remove(name)
+
+    return stats
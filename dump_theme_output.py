@@ -1,14 +1,11 @@
-import bz2
-
-import orjson
-import os
-import pickle
 import sys
 
 from donnees import rcan_coll
+from donnees.predictions import merge_predictions
 from donnees.rcan_coll import *
+from donnees.ref_store import load_theme_reference
 
-_ref_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'donnees', 'resources')
+URL_BATCH_SIZE = 4096
 
 
 def main():
@@ -19,35 +16,36 @@ def main():
     coll_dir = sys.argv[1]
     pred_files = sys.argv[2:]
 
-    theme_refs = pickle.load(bz2.open(os.path.join(_ref_path, 'ref-rcan-themes.pkl.bz2'), 'rb'))
-    rows = {}
-    sys_names = []
+    theme_refs = load_theme_reference()
+    coll = RCollection(coll_dir)
+    sys_names = pred_files
+
+    print('\t'.join(["doc_id", "url", "ref", "unanimity", "all_valid"] + sys_names))
 
-    for pred_file in pred_files:
-        preds = orjson.loads(open(pred_file, 'r', encoding='utf-8').read())
-        sys_names.append(pred_file)
+    # a single streaming pass over all the prediction files, in doc id order. The urls of a block of rows are
+    # fetched together, in the physical order of the collection
+    block = []
+    for doc_id, infos in merge_predictions(pred_files):
+        block.append((doc_id, infos))
+        if len(block) == URL_BATCH_SIZE:
+            print_rows(block, coll, theme_refs)
+            block = []
+    print_rows(block, coll, theme_refs)
 
-        for raw_doc_id, info in preds.items():
-            doc_id = int(raw_doc_id)
-            pred_theme = info["theme"][0][0]
-            row = rows.get(doc_id, {'ref_theme': theme_refs[doc_id][0],
-                                    'url': RDocument(orjson.loads(open(os.path.join(coll_dir, str(doc_id) + ".json"), 'r').read())).url,
-                                    'preds': []})
-            row['preds'].append(pred_theme)
-            rows[doc_id] = row
 
-    print('\t'.join(["doc_id", "url", "ref", "unanimity", "all_valid"] + sys_names))
-    for raw_doc_id in sorted(rows.keys()):
+def print_rows(block, coll, theme_refs):
+    urls = {int(x.id): x.url for x in coll.get_many([doc_id for doc_id, _ in block], fields=[])}
+    for doc_id, infos in block:
         l = []
-        doc_id = int(raw_doc_id)
-        cur_row = rows[doc_id]
+        ref_theme = theme_refs[doc_id][0]
+        preds = [info["theme"][0][0] for info in infos if info is not None]
 
-        unanimity = len(set(cur_row['preds'])) == 1
-        all_valid = unanimity and cur_row['preds'][0] == cur_row['ref_theme']
+        unanimity = len(set(preds)) == 1
+        all_valid = unanimity and preds[0] == ref_theme
 
-        l.extend([str(raw_doc_id), cur_row['url'], rcan_coll.get_theme(cur_row['ref_theme'])['name']])
+        l.extend([str(doc_id), urls[int(doc_id)], rcan_coll.get_theme(ref_theme)['name']])
         l.extend([str(unanimity), str(all_valid)])
-        l.extend([rcan_coll.get_theme(x)['name'] for x in cur_row['preds']])
+        l.extend([rcan_coll.get_theme(x)['name'] for x in preds])
         print('\t'.join(l))
 
 
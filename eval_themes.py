@@ -1,12 +1,12 @@
 """Evaluates themes/subthemes"""
-import bz2
-import orjson
-import os
-import pickle
+import concurrent.futures
+import itertools
+import numpy
 import sys
 import tabulate
 
-_ref_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'donnees', 'resources')
+from donnees.predictions import iter_predictions
+from donnees.ref_store import load_theme_reference
 
 
 def inter_card(lista, listb):
@@ -107,6 +107,255 @@ def evaluate_themes(pred_dict, refs, n_list, run):
     return result
 
 
+class EncodedRun:
+    """
+    The predictions and references of a run, encoded once as arrays of label indices.
+
+    ranked[d, r] is the label predicted at rank r for document d (-1 past the end of the predictions),
+    nb_preds[d] the number of predictions, ref_doc[i] and ref_label[i] the document and label of the i-th
+    reference element, in document order. labels maps label indices back to labels.
+    """
+    def __init__(self, doc_ids, labels, ranked, nb_preds, ref_doc, ref_label):
+        self.doc_ids = doc_ids
+        self.labels = labels
+        self.ranked = ranked
+        self.nb_preds = nb_preds
+        self.ref_doc = ref_doc
+        self.ref_label = ref_label
+
+        # rank of the first prediction equal to each reference element, max_n if none
+        max_n = ranked.shape[1]
+        matches = ranked[ref_doc] == ref_label[:, None]
+        self.ref_first_rank = numpy.where(matches.any(axis=1), matches.argmax(axis=1), max_n)
+
+
+def encode_runs(pred_items, refs, runs, max_n):
+    """
+    Encodes predictions in a single pass.
+    :param pred_items: An iterable of (doc_id, predictions), e.g. pred_dict.items().
+    :param refs: References.
+    :param runs: A list of runs, 'theme' and/or 'sub_themes'.
+    :param max_n: Number of predictions kept per document.
+    :return: A dict run -> EncodedRun.
+    """
+    label_index = {}
+    labels = []
+
+    def index_of(label):
+        idx = label_index.get(label)
+        if idx is None:
+            idx = label_index[label] = len(labels)
+            labels.append(label)
+        return idx
+
+    doc_ids = []
+    data = {run: {'ranked': [], 'nb_preds': [], 'ref_doc': [], 'ref_label': []} for run in runs}
+
+    for doc_id, preds in pred_items:
+        if doc_id in refs:
+            effective_doc_id = doc_id
+        else:
+            effective_doc_id = toggle_type(doc_id)
+            if effective_doc_id not in refs:
+                print(f"Cannot find your predicted doc id {doc_id} in the reference. Make sure "
+                      f"you use ints for doc_id's and theme id's, not strings.", file=sys.stderr)
+                sys.exit(1)
+
+        doc_row = len(doc_ids)
+        doc_ids.append(effective_doc_id)
+        ref = refs[effective_doc_id]
+
+        for run in runs:
+            cur = data[run]
+            predicted = [index_of(x[0]) for x in preds[run][0:max_n]]
+            cur['nb_preds'].append(len(predicted))
+            cur['ranked'].extend(predicted + [-1] * (max_n - len(predicted)))
+
+            reference_elements = [ref[0]] if run == 'theme' else ref[1:]
+            for x in reference_elements:
+                cur['ref_doc'].append(doc_row)
+                cur['ref_label'].append(index_of(x))
+
+    result = {}
+    for run, cur in data.items():
+        result[run] = EncodedRun(doc_ids, labels,
+                                 numpy.array(cur['ranked'], dtype=numpy.int32).reshape(len(doc_ids), max_n),
+                                 numpy.array(cur['nb_preds'], dtype=numpy.int64),
+                                 numpy.array(cur['ref_doc'], dtype=numpy.int64),
+                                 numpy.array(cur['ref_label'], dtype=numpy.int32))
+    return result
+
+
+def evaluate_encoded(enc: EncodedRun, n_list, run):
+    """
+    Same as evaluate_themes, with array operations on an encoded run.
+    :return: a dict of results, identical to the one evaluate_themes returns.
+    """
+    result = {}
+    nb_labels = len(enc.labels)
+    ref_counts = numpy.bincount(enc.ref_label, minlength=nb_labels)
+
+    for n in n_list:
+        top_n = enc.ranked[:, 0:n]
+        valid = enc.ref_first_rank < n
+
+        nb_ref_elements = len(enc.ref_label)
+        nb_predicted_elements = int(numpy.minimum(enc.nb_preds, n).sum())
+        nb_valid_elements = int(valid.sum())
+
+        pred_counts = numpy.bincount(top_n[top_n >= 0], minlength=nb_labels)
+        valid_counts = numpy.bincount(enc.ref_label[valid], minlength=nb_labels)
+
+        # confusions of the missed reference elements, in the order update_label_stats would meet them
+        missed = ~valid
+        confused_preds = top_n[enc.ref_doc[missed]]
+        confused_refs = numpy.broadcast_to(enc.ref_label[missed][:, None], confused_preds.shape)
+        present = confused_preds >= 0
+        pair_codes = confused_refs[present].astype(numpy.int64) * nb_labels + confused_preds[present]
+        codes, first_seen, pair_counts = numpy.unique(pair_codes, return_index=True, return_counts=True)
+
+        by_label_stats = {}
+        for idx in numpy.flatnonzero((ref_counts > 0) | (pred_counts > 0)):
+            by_label_stats[enc.labels[idx]] = {'ref': int(ref_counts[idx]), 'pred': int(pred_counts[idx]),
+                                               'valid': int(valid_counts[idx]), 'confused_with': {}}
+        for k in numpy.argsort(first_seen, kind='stable'):
+            ref_idx, pred_idx = divmod(int(codes[k]), nb_labels)
+            by_label_stats[enc.labels[ref_idx]]['confused_with'][enc.labels[pred_idx]] = int(pair_counts[k])
+
+        cur_res = result[n] = {run: {}}
+        cur_res[run]['r'] = nb_valid_elements / nb_ref_elements
+        cur_res[run]['p'] = nb_valid_elements / nb_predicted_elements
+        cur_res[run]['f1'] = f1(cur_res[run]['r'], cur_res[run]['p'])
+        cur_res[run]['by_label'] = by_label_stats
+
+    return result
+
+
+def evaluate_themes_vectorized(pred_dict, refs, n_list, run):
+    """
+    Vectorized evaluate_themes: predictions are encoded once, then every n is evaluated with array operations.
+    :return: a dict of results, identical to the one evaluate_themes returns.
+    """
+    enc = encode_runs(pred_dict.items(), refs, [run], max(n_list))[run]
+    return evaluate_encoded(enc, n_list, run)
+
+
+def doc_counts(enc: EncodedRun, n) -> numpy.ndarray:
+    """
+    :return: A (3, nb_docs) array with, for every document, its number of valid, predicted and reference
+    elements @n.
+    """
+    nb_docs = len(enc.doc_ids)
+    valid = numpy.bincount(enc.ref_doc[enc.ref_first_rank < n], minlength=nb_docs)
+    predicted = numpy.minimum(enc.nb_preds, n)
+    reference = numpy.bincount(enc.ref_doc, minlength=nb_docs)
+    return numpy.stack([valid, predicted, reference])
+
+
+def prf_from_sums(sums) -> numpy.ndarray:
+    """
+    :param sums: An array (..., 3) of summed valid, predicted and reference counts.
+    :return: An array (..., 3) of precision, recall and f1.
+    """
+    sums = numpy.asarray(sums, dtype=numpy.float64)
+    valid, predicted, reference = sums[..., 0], sums[..., 1], sums[..., 2]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        p = numpy.where(predicted > 0, valid / predicted, 0.0)
+        r = numpy.where(reference > 0, valid / reference, 0.0)
+        f = numpy.where(p + r > 0, 2 * r * p / (r + p), 0.0)
+    return numpy.stack([p, r, f], axis=-1)
+
+
+def _count_patterns(counts):
+    """
+    Documents with the same counts are interchangeable in a resample: resampling them is equivalent to drawing
+    how many times each distinct count pattern is picked.
+    :return: The distinct columns of counts, (rows, k), and the number of documents having each of them.
+    """
+    patterns, multiplicity = numpy.unique(counts.T, axis=0, return_counts=True)
+    return patterns.T, multiplicity
+
+
+def _resample_batches(nb_resamples, nb_patterns, seed):
+    """Splits resamples into batches of at most ~8M draws, each with its own random stream."""
+    batch_size = max(1, min(nb_resamples, (1 << 23) // max(nb_patterns, 1)))
+    sizes = [min(batch_size, nb_resamples - x) for x in range(0, nb_resamples, batch_size)]
+    seeds = numpy.random.SeedSequence(seed).spawn(len(sizes))
+    return list(zip(sizes, seeds))
+
+
+def _map_batches(fn, arg, batches, workers):
+    if workers and workers > 1 and len(batches) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(fn, [arg] * len(batches), batches))
+    return [fn(arg, x) for x in batches]
+
+
+def _bootstrap_batch(args, batch):
+    patterns, multiplicity = args
+    size, seed = batch
+    rng = numpy.random.default_rng(seed)
+    # number of times each pattern is drawn when resampling all the documents with replacement
+    draws = rng.multinomial(multiplicity.sum(), multiplicity / multiplicity.sum(), size=size)
+    return prf_from_sums(draws @ patterns.T)
+
+
+def bootstrap_ci(counts, nb_resamples=10000, alpha=0.05, seed=42, workers=None):
+    """
+    Percentile bootstrap confidence intervals of micro P/R/F1, resampling documents with replacement.
+    :param counts: Per document counts, see doc_counts.
+    :param workers: Spread the resamples over this many processes.
+    :return: An array (3, 2) of the lower and upper bounds of p, r and f1.
+    """
+    patterns, multiplicity = _count_patterns(counts)
+    batches = _resample_batches(nb_resamples, len(multiplicity), seed)
+    metrics = numpy.concatenate(_map_batches(_bootstrap_batch, (patterns, multiplicity), batches, workers))
+    return numpy.percentile(metrics, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0).T
+
+
+def _randomization_batch(args, batch):
+    sums_a, sums_b, diff, multiplicity, observed = args
+    size, seed = batch
+    rng = numpy.random.default_rng(seed)
+    # number of swapped documents among the documents sharing each pattern
+    swaps = rng.binomial(multiplicity, 0.5, size=(size, len(multiplicity)))
+    shift = swaps @ diff.T
+    delta = numpy.abs(prf_from_sums(sums_a + shift) - prf_from_sums(sums_b - shift))
+    return (delta >= observed - 1e-12).sum(axis=0)
+
+
+def paired_randomization_test(counts_a, counts_b, nb_resamples=10000, seed=42, workers=None):
+    """
+    Paired approximate randomization test of the difference of micro P/R/F1 between two systems evaluated on
+    the same documents: the outputs of the two systems are swapped at random for every document.
+    :param counts_a: Per document counts of system a, see doc_counts.
+    :param counts_b: Per document counts of system b, on the same documents in the same order.
+    :param workers: Spread the resamples over this many processes.
+    :return: The p-values for p, r and f1.
+    """
+    sums_a = counts_a.sum(axis=1)
+    sums_b = counts_b.sum(axis=1)
+    observed = numpy.abs(prf_from_sums(sums_a) - prf_from_sums(sums_b))
+    patterns, multiplicity = _count_patterns(numpy.concatenate([counts_a, counts_b]))
+    diff = patterns[3:] - patterns[:3]
+    args = (sums_a, sums_b, diff, multiplicity, observed)
+
+    batches = _resample_batches(nb_resamples, len(multiplicity), seed)
+    nb_extreme = sum(_map_batches(_randomization_batch, args, batches, workers))
+    return (nb_extreme + 1) / (nb_resamples + 1)
+
+
+def align_counts(enc_a: EncodedRun, counts_a, enc_b: EncodedRun, counts_b):
+    """
+    Restricts the per document counts of two systems to their common documents, in the same order.
+    """
+    rows_b = {doc_id: row for row, doc_id in enumerate(enc_b.doc_ids)}
+    pairs = [(row, rows_b[doc_id]) for row, doc_id in enumerate(enc_a.doc_ids) if doc_id in rows_b]
+    rows_a = numpy.array([x[0] for x in pairs], dtype=numpy.int64)
+    rows_b = numpy.array([x[1] for x in pairs], dtype=numpy.int64)
+    return counts_a[:, rows_a], counts_b[:, rows_b]
+
+
 def print_eval_metrics(eval_res):
     rows = []
     for n in sorted(eval_res.keys()):
@@ -146,22 +395,26 @@ def main():
         sys.exit(1)
 
     print("Loading...", end='\n\n', file=sys.stderr, flush=True)
-    preds = orjson.loads(open(sys.argv[1], 'r', encoding='utf-8').read())
-    theme_refs = pickle.load(bz2.open(os.path.join(_ref_path, 'ref-rcan-themes.pkl.bz2'), 'rb'))
+    theme_refs = load_theme_reference()
 
-    first_eval = preds[list(preds.keys())[0]]
+    # predictions are streamed and encoded in a single pass, never held as a dict
+    preds = iter_predictions(sys.argv[1])
+    first_item = next(preds)
+    first_eval = first_item[1]
+    runs = [x for x in ['theme', 'sub_themes'] if x in first_eval]
+    encoded = encode_runs(itertools.chain([first_item], preds), theme_refs, runs, 5)
 
     if 'theme' in first_eval:
-        eval_res_th = evaluate_themes(preds, theme_refs, range(1, 6), 'theme')
+        eval_res_th = evaluate_encoded(encoded['theme'], range(1, 6), 'theme')
         print(f"Themes ====================")
         print_eval_metrics(eval_res_th)
         print(f"By label @ 1 --------------")
         print_eval_metrics_by_class(eval_res_th, 'theme', 1)
 
     if 'sub_themes' in first_eval:
-        eval_res_sth = evaluate_themes(preds, theme_refs, range(1, 6), 'sub_themes')
+        eval_res_sth = evaluate_encoded(encoded['sub_themes'], range(1, 6), 'sub_themes')
         print(f"SubThemes =================")
-        print_eval_metrics(eval_res_sth, 1)
+        print_eval_metrics(eval_res_sth)
         print(f"By label @1 ---------------")
         print_eval_metrics_by_class(eval_res_sth, 'sub_themes', 1)
 
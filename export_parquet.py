@@ -0,0 +1,38 @@
+"""
+Exports a collection to a Parquet dataset partitioned by split, see donnees/export.py.
+
+Usage: export_parquet.py coll_dir out_dir [split_dir|-] [nb_workers] [field,field,...]
+With a split_dir holding the train/valid/test.ids files of create_rcan_split.py, only the documents of these
+splits are exported; with '-', the whole collection is.
+"""
+import sys
+
+from donnees.export import export_collection, split_files
+from donnees.rcan_coll import RCollection
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: prog coll_dir out_dir [split_dir|-] [nb_workers] [field,field,...]", file=sys.stderr)
+        sys.exit(1)
+
+    coll_dir = sys.argv[1]
+    out_dir = sys.argv[2]
+    split_dir = sys.argv[3] if len(sys.argv) > 3 and sys.argv[3] != '-' else None
+    nb_workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    fields = [x for x in sys.argv[5].split(',') if x] if len(sys.argv) > 5 else []
+
+    splits = None
+    if split_dir is not None:
+        splits = split_files(split_dir)
+        if not splits:
+            print(f"No split files in {split_dir}", file=sys.stderr)
+            sys.exit(1)
+
+    nb_docs = export_collection(RCollection(coll_dir), out_dir, splits, fields, nb_workers)
+    for name, nb in nb_docs.items():
+        print(f"{name}: {nb} documents")
+
+
+if __name__ == '__main__':
+    main()
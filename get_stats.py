@@ -1,10 +1,24 @@
 """
 Prints cute stats on JSON fields.
+
+Usage: get_stats.py [coll_dir] [nb_workers] [sample_size]
+
+With a sample size, only that many documents drawn at random are profiled, and the percentages and totals are
+printed with their 95% error bounds.
 """
 from donnees.rcan_coll import *
 
+import math
 import re
 
+import numpy
+
+DEFAULT_COLL_DIR = '/data/rali6/Tmp/gottif/radiocan/data/radio-can-articles/'
+Z_95 = 1.96
+
+# very roughly, no tokenizer: a token is a maximal run of characters that are not spaces or ,;:"
+_TOKEN_RE = re.compile(r'[^\s,;:"]+')
+
 
 def stat_keys(d, stat_info):
     for key_name, value in d.items():
@@ -37,33 +51,105 @@ def stat_keys(d, stat_info):
                 stat_keys(value, stat_info[key_name]['children'])
 
 
-def rec_print(stat_info, depth, nb_docs):
+def merge_stat_info(stat_info, other):
+    """
+    Adds the frequencies of other to stat_info. Returns stat_info.
+    """
+    for key_name, info in other.items():
+        if key_name not in stat_info:
+            stat_info[key_name] = info
+        else:
+            stat_info[key_name]['freq'] += info['freq']
+            merge_stat_info(stat_info[key_name]['children'], info['children'])
+    return stat_info
+
+
+def count_tokens(paras: list) -> int:
+    return len(_TOKEN_RE.findall('\n'.join(paras)))
+
+
+def profile_docs(docs) -> dict:
+    """
+    :param docs: An iterable of RDocument.
+    :return: The profile of docs: the field frequency tree, the number of docs, and the sums and sums of squares
+    of the number of body paragraphs and tokens per doc.
+    """
+    stat_info = {}
+    counts = []
+    for doc in docs:
+        stat_keys(doc._d, stat_info)
+        paras = doc.extract_body_paragraphs()
+        counts.append((len(paras), count_tokens(paras)))
+
+    counts = numpy.array(counts, dtype=numpy.int64).reshape(-1, 2)
+    return {'stat_info': stat_info, 'nb_docs': len(counts), 'sums': counts.sum(axis=0),
+            'squares': (counts * counts).sum(axis=0)}
+
+
+def merge_profiles(profile, other) -> dict:
+    """Merges two profiles computed over different docs. Returns profile."""
+    merge_stat_info(profile['stat_info'], other['stat_info'])
+    profile['nb_docs'] += other['nb_docs']
+    profile['sums'] += other['sums']
+    profile['squares'] += other['squares']
+    return profile
+
+
+def finite_population_correction(nb_docs: int, population: int) -> float:
+    if population is None or population <= 1:
+        return 1.0
+    return max(0.0, (population - nb_docs) / (population - 1))
+
+
+def rec_print(stat_info, depth, nb_docs, population=None):
+    """
+    :param population: In sampling mode, the number of docs in the collection, to print error bounds.
+    """
     indent = depth * '\t'
+    fpc = finite_population_correction(nb_docs, population)
     for key in sorted(stat_info.keys()):
-        print(f"{indent}{key}: {100 * stat_info[key]['freq'] / nb_docs:.1f}%")
+        p = stat_info[key]['freq'] / nb_docs
+        if population is None:
+            print(f"{indent}{key}: {100 * p:.1f}%")
+        else:
+            print(f"{indent}{key}: {100 * p:.1f}% ± {100 * Z_95 * math.sqrt(p * (1 - p) / nb_docs * fpc):.1f}")
         if stat_info[key]['children']:
-            rec_print(stat_info[key]['children'], depth + 1, nb_docs)
+            rec_print(stat_info[key]['children'], depth + 1, nb_docs, population)
 
 
-def main():
-    coll = RCollection('/data/rali6/Tmp/gottif/radiocan/data/radio-can-articles/')
-    stat_info = {}
-    nb_docs = 0
-    nb_paras = 0
-    nb_toks = 0
+def print_totals(profile, population=None):
+    nb_docs = profile['nb_docs']
+    nb_paras, nb_toks = profile['sums'].tolist()
+    if population is None:
+        print(f"Nb docs: {nb_docs}, body paragraphs: {nb_paras}, body tokens: ~{nb_toks}")
+        return
 
-    for doc in coll.find():
-        stat_keys(doc._d, stat_info)
+    # totals estimated from the sample means, with their standard errors
+    means = profile['sums'] / nb_docs
+    variances = (profile['squares'] / nb_docs - means * means) * nb_docs / max(1, nb_docs - 1)
+    errors = Z_95 * population * numpy.sqrt(variances / nb_docs * finite_population_correction(nb_docs, population))
+    totals = population * means
+    print(f"Nb docs: {population} (sample of {nb_docs}), "
+          f"body paragraphs: ~{totals[0]:.0f} ± {errors[0]:.0f}, body tokens: ~{totals[1]:.0f} ± {errors[1]:.0f}")
 
-        nb_docs += 1
-        nb_paras += len(doc.extract_body_paragraphs())
-        for para in doc.extract_body_paragraphs():
-            for tok in re.split(r'\s|,|;|:|"', para):  # very roughly, no tokenizer
-                if tok:
-                    nb_toks += 1
 
-    rec_print(stat_info, 0, nb_docs)
-    print(f"Nb docs: {nb_docs}, body paragraphs: {nb_paras}, body tokens: ~{nb_toks}")
+def main():
+    coll_dir = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_COLL_DIR
+    nb_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    sample_size = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    coll = RCollection(coll_dir)
+    profile = coll.map_reduce(profile_docs, merge_profiles, workers=nb_workers, sample=sample_size)
+    if profile is None or not profile['nb_docs']:
+        print("No documents.", file=sys.stderr)
+        sys.exit(1)
+
+    population = len(coll.source.entries())
+    if sample_size is None or sample_size >= population:
+        population = None
+
+    rec_print(profile['stat_info'], 0, profile['nb_docs'], population)
+    print_totals(profile, population)
 
 
 if __name__ == '__main__':
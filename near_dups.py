@@ -0,0 +1,38 @@
+"""
+Finds the near-duplicate articles of a collection, building its near-duplicate index the first time.
+
+Usage: near_dups.py coll_dir [nb_workers] [threshold=0.8] [clusters_file]
+
+Writes one cluster per line, the doc ids separated by spaces, the representative (smallest id) first.
+"""
+import os
+import sys
+
+from donnees.near_dup import THRESHOLD, near_dup_index
+from donnees.rcan_coll import RCollection
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: prog coll_dir [nb_workers] [threshold] [clusters_file]", file=sys.stderr)
+        sys.exit(1)
+
+    coll = RCollection(sys.argv[1])
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    threshold = float(sys.argv[3]) if len(sys.argv) > 3 else THRESHOLD
+    clusters_file = sys.argv[4] if len(sys.argv) > 4 else None
+
+    index = near_dup_index(coll, workers, threshold=threshold)
+    clusters = index.clusters()
+    nb_duplicates = sum(len(x) for x in clusters)
+    print(f"{len(index)} documents, {len(clusters)} clusters of near-duplicates holding {nb_duplicates} documents, "
+          f"largest {len(clusters[0]) if clusters else 0}.")
+
+    if clusters_file is not None:
+        with open(clusters_file, 'w', encoding='utf-8') as fout:
+            for cluster in clusters:
+                fout.write(' '.join(str(x) for x in cluster) + '\n')
+
+
+if __name__ == '__main__':
+    main()
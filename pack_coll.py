@@ -0,0 +1,22 @@
+"""Rolls a collection directory into a packed collection (a few large shards plus an offset index)."""
+import sys
+
+from donnees.rcan_pack import pack_collection
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: prog in_dir out_dir [zstd|zstd-dict]", file=sys.stderr)
+        sys.exit(1)
+
+    in_dir = sys.argv[1]
+    out_dir = sys.argv[2]
+    compress = len(sys.argv) > 3 and sys.argv[3] in ('zstd', 'zstd-dict')
+    dictionary = len(sys.argv) > 3 and sys.argv[3] == 'zstd-dict'
+
+    nb_docs = pack_collection(in_dir, out_dir, compress=compress, dictionary=dictionary)
+    print(f"{nb_docs} documents packed in {out_dir}")
+
+
+if __name__ == '__main__':
+    main()
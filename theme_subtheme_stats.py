@@ -1,58 +1,50 @@
 """
 Prints theme/subtheme stats on theme/subthemes.
 """
-import pickle
-
 from donnees.rcan_coll import *
+from donnees.theme_stats import ThemeStats, update_stats
 
 import numpy
-import tqdm
 
 
 def main():
-    coll = RCollection('/data/rali6/Tmp/gottif/radiocan/data/radio-can-articles/')
-
-    if os.path.exists('matrix.pkl'):
-        freqs = pickle.load(open('matrix.pkl', 'rb'))
-    else:
-        freqs = numpy.zeros((467, 26))
-
-        for doc in tqdm.tqdm(coll.find(), total=601000):
-            theme = doc.theme['id'] if doc.theme else 0
-            subthemes = [x['id'] for x in doc.subthemes] if doc.subthemes else [0]
-
-            for sth in subthemes:
-                freqs[sth][theme] += 1
+    coll_dir = sys.argv[1] if len(sys.argv) > 1 else '/data/rali6/Tmp/gottif/radiocan/data/radio-can-articles/'
+    stats_prefix = sys.argv[2] if len(sys.argv) > 2 else 'theme_stats'
+    nb_workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
 
-        pickle.dump(freqs, open('matrix.pkl', 'wb'))
+    # only the files added or modified since the last run are counted
+    stats = update_stats(RCollection(coll_dir), ThemeStats.load(stats_prefix), nb_workers)
+    stats.save(stats_prefix)
+    freqs = stats.freqs
+    nb_subthemes, nb_themes = freqs.shape
 
     print("SubThemeId\tSubThemeCodename\tTotalOccurences\t", end='')
-    for th_id in range(0, 26):
+    for th_id in range(0, nb_themes):
         print(get_theme(th_id)['codename'] + ('' if get_theme(th_id)['active'] else ' (inactif)') + '\t', end='')
     print()
 
-    for sth_id in range(0, 467):
+    for sth_id in range(0, nb_subthemes):
         try:
             codename = get_subtheme(sth_id)['codename'] if sth_id else 'no_subtheme'
             if sth_id != 0 and not get_subtheme(sth_id)['active']:
                 codename += ' (inactif)'
 
             print(str(sth_id) + '\t' + codename + '\t' + str(numpy.sum(freqs[sth_id])) + '\t', end='')
-            print('\t'.join([str(freqs[sth_id][th_id]) for th_id in range(0, 26)]))
+            print('\t'.join([str(freqs[sth_id][th_id]) for th_id in range(0, nb_themes)]))
         except KeyError as e:
             pass
 
     print('\n\n\n')
 
     # print child-parent matrix
-    for sth_id in range(0, 467):
+    for sth_id in range(0, nb_subthemes):
         try:
             parent_id = get_subtheme(sth_id)['theme'] if sth_id else 0
             if type(parent_id) == list:
                 assert len(parent_id) == 0
                 parent_id = 0
 
-            row = [0] * 27
+            row = [0] * (nb_themes + 1)
             row[0] = sth_id
             row[parent_id + 1] = 1
             print('\t'.join([str(x) for x in row]))